@@ -0,0 +1,119 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+from threading import Event
+
+from data_parser import RawData
+
+# inotify events that can change an archive in a watched folder
+_IN_MODIFY = 0x2
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+
+class _Inotify:
+    # The folders' inotify descriptor, through libc so there is nothing to install. Raises OSError where
+    # inotify is not available.
+    def __init__(self, folders):
+        name = ctypes.util.find_library("c")
+        if not hasattr(os, "O_NONBLOCK") or name is None:
+            raise OSError("inotify不可用")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify不可用")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        for i in folders:
+            if libc.inotify_add_watch(self.fd, os.fsencode(i), _IN_MASK) < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, "inotify_add_watch", i)
+
+    def wait(self, timeout: float):
+        # True if events came within timeout, they are read and dropped: the snapshot says what changed
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        try:
+            while len(os.read(self.fd, 65536)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ArchiveWatcher:
+    # Watches the archives a scan reads, those of data, UserMods and Maps, with inotify where there is one and by
+    # polling every interval seconds otherwise. wait returns once they changed and then stayed the same for
+    # debounce seconds, so an archive still being copied is reported only when the copy is done.
+    def __init__(self, h5_path: str, debounce: float = 1.0, interval: float = 2.0, use_inotify: bool = True):
+        self.h5_path = h5_path
+        self.debounce = debounce
+        self.interval = interval
+        self.stop_event = Event()
+        self.snapshot = self._snapshot()
+        self.inotify = None
+        if use_inotify:
+            folders = [os.path.join(h5_path, i) for i in RawData.DIRS]
+            try:
+                self.inotify = _Inotify([i for i in folders if os.path.isdir(i)])
+            except OSError as e:
+                logging.info("  无法使用inotify（%s），改为每%.1f秒检查一次", e, interval)
+
+    def _snapshot(self):
+        # {archive: (size, mtime)}, an archive removed before it was stat'ed is left out
+        result = {}
+        for _, _, fullname in RawData.list_archives(self.h5_path):
+            try:
+                st = os.stat(fullname)
+            except OSError:
+                continue
+            result[fullname] = st.st_size, st.st_mtime_ns
+        return result
+
+    def _sleep(self, timeout: float):
+        if self.inotify is None:
+            self.stop_event.wait(timeout)
+        else:
+            self.inotify.wait(timeout)
+
+    def wait(self):
+        # Archives added, rewritten or removed since the last call, an empty set once stop was called
+        while not self.stop_event.is_set():
+            # inotify wakes up at once, the timeout only catches folders created after the watch was set up
+            self._sleep(self.interval if self.inotify is None else max(self.interval, 30.0))
+            current = self._snapshot()
+            if current == self.snapshot:
+                continue
+            while not self.stop_event.is_set():
+                self.stop_event.wait(self.debounce)
+                settled = self._snapshot()
+                if settled == current:
+                    break
+                current = settled
+            if self.stop_event.is_set():
+                break
+            changed = set(k for k in current.keys() | self.snapshot.keys() if current.get(k) != self.snapshot.get(k))
+            self.snapshot = current
+            if len(changed) > 0:
+                return changed
+        return set()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        self.stop()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
@@ -0,0 +1,154 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+
+from persistence import per
+from data_parser import RawData, GameInfo, MAP_ENGINES, get_peak_rss
+from fake_install import SCALES, build
+from cli import default_options
+from creature_table import CreatureInfo, CreatureTable
+
+# Timings depend on the machine, so the baseline is not kept in the repository: save one with --save-baseline first
+BASELINE_FILE = "bench_baseline.json"
+STAGES = ("scan", "preload_maps", "preload_heroes", "preload_creatures", "work_maps", "work_heroes",
+          "work_creatures", "total")
+
+
+def run_once(root: str, map_workers: int, map_engine: str):
+    # Stage wall times of one cold, non incremental build of the install at root
+    per.last_path = root
+    prev_timeit = time()
+    data = RawData(root, use_cache=False)
+    data.run()
+    game_info = GameInfo(map_workers=map_workers, map_engine=map_engine)
+    game_info.preload(data)
+    map_options, hero_options = default_options(game_info)
+    game_info.work(map_options, hero_options, incremental=False)
+    result = {**data.stage_times, **game_info.stage_times}
+    result["total"] = time() - prev_timeit
+    return result
+
+
+def run_scale(name: str, repeat: int, map_workers: int, map_engine: str):
+    # Best of repeat runs for every stage
+    best = {}
+    with TemporaryDirectory(prefix=f"h5bench_{name}_") as root:
+        build(root, SCALES[name])
+        for _ in range(repeat):
+            for stage, elapsed in run_once(root, map_workers, map_engine).items():
+                best[stage] = min(best.get(stage, elapsed), elapsed)
+    return best
+
+
+def run_creatures(count: int, repeat: int):
+    # Best build and Lua emit times of a creature table of count creatures, upgrade lines of three like the game's
+    towns = ("TOWN_HEAVEN", "TOWN_INFERNO", "TOWN_NEUTRAL")
+    town_values = {k: i for i, k in enumerate(towns)}
+    best = {}
+    for _ in range(repeat):
+        table = CreatureTable()
+        for i in range(count):
+            base = i - i % 3
+            upgrades = (f"CREATURE_{base + 1}", f"CREATURE_{base + 2}") if i % 3 == 0 else ()
+            table.add(f"CREATURE_{i}", CreatureInfo(towns[i // 21 % len(towns)], 10 + i, f"/Text/{i}.txt",
+                                                     i // 3 % 7 + 1, upgrades))
+        prev_timeit = perf_counter()
+        table.build(town_values)
+        elapsed = {"creature_build": perf_counter() - prev_timeit}
+        prev_timeit = perf_counter()
+        table.lua()
+        elapsed["creature_lua"] = perf_counter() - prev_timeit
+        for stage, value in elapsed.items():
+            best[stage] = min(best.get(stage, value), value)
+    return best
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_seconds: float):
+    # (scale, stage, baseline, current, ratio) of every stage slower than threshold times its baseline;
+    # stages under min_seconds in both runs are noise and skipped
+    regressions = []
+    for name, stages in results.items():
+        for stage, elapsed in stages.items():
+            base = baseline.get(name, {}).get(stage)
+            if base is None or max(base, elapsed) < min_seconds:
+                continue
+            ratio = elapsed / base if base > 0 else float("inf")
+            if ratio > threshold:
+                regressions.append((name, stage, base, elapsed, ratio))
+    return regressions
+
+
+def print_table(results: dict, baseline: dict):
+    print(f"{'scale':<8}{'stage':<20}{'seconds':>10}{'baseline':>10}{'ratio':>8}")
+    for name, stages in results.items():
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+            elapsed = stages[stage]
+            base = baseline.get(name, {}).get(stage)
+            base_text = "-" if base is None else f"{base:.3f}"
+            ratio_text = "-" if not base else f"{elapsed / base:.2f}"
+            print(f"{name:<8}{stage:<20}{elapsed:>10.3f}{base_text:>10}{ratio_text:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在假安装文件夹上测量各阶段耗时，并与保存的基准比较",
+                                     epilog="基准与机器有关，不随代码提供：第一次运行时先用--save-baseline在本机保存基准，"
+                                            "之后的运行才会与之比较并报告退步")
+    parser.add_argument("--scales", nargs="+", choices=tuple(SCALES), default=["small", "medium"])
+    parser.add_argument("--repeat", type=int, default=3, help="每个规模运行的次数，取各阶段最快的一次")
+    parser.add_argument("--map-workers", type=int, default=None)
+    parser.add_argument("--map-engine", choices=tuple(MAP_ENGINES), default="tree")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help=f"基准文件，默认为{BASELINE_FILE}")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为新的基准")
+    parser.add_argument("--threshold", type=float, default=1.25, help="比基准慢多少倍算作退步")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="低于该耗时的阶段不参与比较")
+    parser.add_argument("--output", default=None, help="本次结果另存的JSON文件")
+    parser.add_argument("--creatures", type=int, default=None, help="只测量该数量生物的生物表构建和Lua生成")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR, format="%(message)s")
+
+    if args.creatures is not None:
+        for stage, elapsed in run_creatures(args.creatures, args.repeat).items():
+            print(f"{stage:<20}{elapsed:>10.4f}")
+        return 0
+
+    results = {name: run_scale(name, args.repeat, args.map_workers, args.map_engine) for name in args.scales}
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, encoding="utf8") as fp:
+            baseline = json.load(fp)["scales"]
+    print_table(results, baseline)
+    peak_rss = get_peak_rss()
+    if peak_rss is not None:
+        print(f"主进程内存峰值{peak_rss / 1048576:.1f}MB")
+
+    report = {"version": per.VERSION, "map_workers": args.map_workers, "map_engine": args.map_engine,
+              "scales": results}
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf8") as fp:
+            json.dump(report, fp, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf8") as fp:
+            json.dump(report, fp, ensure_ascii=False, indent=2)
+        print(f"基准已保存到{args.baseline}")
+        return 0
+    if len(baseline) == 0:
+        print(f"没有找到基准文件{args.baseline}，未作比较，请先用--save-baseline保存基准")
+        return 2
+
+    regressions = compare(results, baseline, args.threshold, args.min_seconds)
+    for name, stage, base, elapsed, ratio in regressions:
+        print(f"退步：{name}规模的{stage}阶段从{base:.3f}秒变为{elapsed:.3f}秒（{ratio:.2f}倍）")
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
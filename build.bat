@@ -6,5 +6,4 @@ pyinstaller -F main.pyw ^
     --add-data "AllSpellsNoAdventure.xml;." ^
     --add-data "RAB*.xml;." ^
     --add-data "spells_*.xml;." ^
-    --add-data "7z.exe;." ^
     --add-data "MapScript.*;." ^
\ No newline at end of file
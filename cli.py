@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from time import time
+from zipfile import ZipFile
+
+from persistence import per
+from data_parser import (RawData, GameInfo, MapsStatusClass, HeroesStatusClass, MAP_ENGINES, HERO_ENGINES,
+                         PATCH_FILE_NAME, get_peak_rss)
+from tracing import tracer
+from archive_watcher import ArchiveWatcher
+
+MAP_CATEGORIES = ("scenario", "singlemissions", "multiplayer", "customized")
+
+
+def _parse_fields(text: str, fields: tuple):
+    # "all_heroes,racial_ability_boost" -> set of field names, "none" for an empty set
+    if text.strip().lower() == "none":
+        return set()
+    result = set(i.strip() for i in text.split(",") if i.strip() != "")
+    unknown = result - set(fields)
+    if len(unknown) > 0:
+        raise argparse.ArgumentTypeError(f"未知选项{', '.join(sorted(unknown))}，可用选项：{', '.join(fields)}")
+    return result
+
+
+def _parse_map_option(text: str):
+    cat, sep, fields = text.partition("=")
+    if sep == "" or cat not in MAP_CATEGORIES:
+        raise argparse.ArgumentTypeError(f"格式应为“类别=选项,选项”，类别可为：{', '.join(MAP_CATEGORIES)}")
+    return cat, _parse_fields(fields, MapsStatusClass._fields)
+
+
+def _parse_hero_option(text: str):
+    return _parse_fields(text, HeroesStatusClass._fields)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="不经图形界面生成兼容补丁，并输出JSON格式的运行报告")
+    parser.add_argument("h5_path", help="英雄无敌5安装文件夹")
+    parser.add_argument("--maps", action="append", default=[], type=_parse_map_option, metavar="类别=选项,...",
+                        help="某类地图的兼容选项，可重复；未指定的类别与图形界面的默认勾选相同")
+    parser.add_argument("--heroes", type=_parse_hero_option, default=None, metavar="选项,...",
+                        help="现有英雄的兼容选项，none表示不勾选")
+    parser.add_argument("--map-workers", type=int, default=None, help="处理地图的进程数，默认为CPU核数")
+    parser.add_argument("--map-engine", choices=tuple(MAP_ENGINES), default="tree",
+                        help="tree整体重新序列化，stream流式处理，edit只改写涉及的片段并保留原有格式")
+    parser.add_argument("--hero-engine", choices=HERO_ENGINES, default="tree")
+    parser.add_argument("--compress-workers", type=int, default=None, help="压缩补丁文件的线程数，默认为CPU核数")
+    parser.add_argument("--scan-workers", type=int, default=None, help="扫描压缩文件的线程数")
+    parser.add_argument("--no-cache", action="store_true", help="不使用也不更新清单缓存和根标签索引")
+    parser.add_argument("--full", action="store_true", help="不沿用旧补丁中未改变的文件")
+    parser.add_argument("--watch", action="store_true",
+                        help="生成后继续监视data、UserMods和Maps，压缩文件有变化时只重新读取变化的部分并更新补丁，按Ctrl+C结束")
+    parser.add_argument("--debounce", type=float, default=1.0, help="监视时压缩文件保持不变多少秒后才更新补丁")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="无法使用inotify时检查压缩文件的间隔秒数")
+    parser.add_argument("--report", default=None, help="报告写入的文件，默认输出到标准输出")
+    parser.add_argument("--log", default=None, help="日志写入的文件，默认输出到标准错误")
+    parser.add_argument("--verbose", action="store_true", help="同时输出逐个文件的日志")
+    parser.add_argument("--overrides", action="store_true", help="在标准错误输出哪些压缩文件覆盖了哪些文件")
+    parser.add_argument("--trace", default=None, help="记录各阶段、压缩文件、地图和英雄的耗时，以Chrome trace格式写入该文件")
+    parser.add_argument("--trace-summary", action="store_true", help="在标准错误输出最慢的压缩文件、地图和英雄")
+    parser.add_argument("--profile", action="append", default=[], metavar="阶段",
+                        help="用cProfile分析该阶段，如scan、preload_maps、work_maps，可重复")
+    parser.add_argument("--tracemalloc", action="append", default=[], metavar="阶段",
+                        help="用tracemalloc记录该阶段的内存分配，可重复")
+    return parser
+
+
+def default_options(game_info: GameInfo):
+    # Same as the check boxes MainWnd ticks at start: every installed mod, but no all heroes in campaigns
+    map_options = {k: MapsStatusClass(*(i is not None for i in game_info.mod_status)) for k in MAP_CATEGORIES}
+    map_options["scenario"] = map_options["scenario"]._replace(all_heroes=False)
+    hero_options = HeroesStatusClass(*game_info.hero_status)
+    return map_options, hero_options
+
+
+def _archive_bytes(data: RawData):
+    result = 0
+    for _, _, fullname in data.archives:
+        try:
+            result += os.path.getsize(fullname)
+        except OSError:
+            pass
+    return result
+
+
+def _patch_stats(patch: str):
+    if not os.path.isfile(patch):
+        return 0, 0, 0
+    with ZipFile(patch) as zf:
+        infolist = zf.infolist()
+    return len(infolist), os.path.getsize(patch), sum(i.file_size for i in infolist)
+
+
+def new_session(args):
+    data = RawData(args.h5_path, use_cache=not args.no_cache, scan_workers=args.scan_workers,
+                   keep_scanned=args.watch)
+    game_info = GameInfo(map_workers=args.map_workers, map_engine=args.map_engine,
+                         compress_workers=args.compress_workers, hero_engine=args.hero_engine)
+    return data, game_info
+
+
+def run(args, session=None, changed=None):
+    # session, the (RawData, GameInfo) of an earlier run, is updated for the archives in changed only
+    report = {"version": per.VERSION, "h5_path": args.h5_path, "ok": False, "error": None, "stages": {}}
+    per.last_path = args.h5_path
+    prev_timeit = time()
+    data = None
+    game_info = None
+    try:
+        data, game_info = new_session(args) if session is None else session
+        if changed is None:
+            data.run()
+        else:
+            data.refresh(changed)
+        report["stages"]["scan"] = time() - prev_timeit
+        if args.overrides:
+            print(data.vfs.report(), file=sys.stderr)
+
+        stage_timeit = time()
+        game_info.preload(data, changed)
+        report["stages"]["preload"] = time() - stage_timeit
+
+        map_options, hero_options = default_options(game_info)
+        for cat, fields in args.maps:
+            map_options[cat] = MapsStatusClass(*(i in fields for i in MapsStatusClass._fields))
+        if args.heroes is not None:
+            hero_options = HeroesStatusClass(*(i in args.heroes for i in HeroesStatusClass._fields))
+        report["options"] = {"maps": {k: v._asdict() for k, v in map_options.items()},
+                             "heroes": hero_options._asdict()}
+
+        stage_timeit = time()
+        game_info.work(map_options, hero_options, incremental=not args.full)
+        report["stages"]["work"] = time() - stage_timeit
+        report["ok"] = True
+    except (ValueError, InterruptedError, OSError) as e:
+        report["error"] = str(e) or type(e).__name__
+        logging.warning("出错，任务中断！%s", report['error'])
+    report["stages"]["total"] = time() - prev_timeit
+
+    patch = os.path.join(args.h5_path, "UserMODs", PATCH_FILE_NAME)
+    patch_entries, patch_bytes, patch_file_bytes = _patch_stats(patch) if report["ok"] else (0, 0, 0)
+    report["patch"] = patch if report["ok"] else None
+    report["details"] = {**(data.stage_times if data is not None else {}),
+                         **(game_info.stage_times if game_info is not None else {})}
+    report["files"] = {
+        "archives": len(data.archives) if data is not None and data.archives is not None else 0,
+        "manifest": len(data.vfs) if data is not None and data.vfs is not None else 0,
+        "shadowed": len(data.vfs.shadowed) if data is not None and data.vfs is not None else 0,
+        "map_xdbs": sum(len(i) for i in getattr(game_info, "map_xdbs", {}).values()),
+        "hero_xdbs": len(getattr(game_info, "hero_xdbs", {})),
+        "creatures": game_info.num_creatures if game_info is not None else 0,
+        "patch_entries": patch_entries,
+        "patch_reused": game_info.patch_index.reused if report["ok"] else 0}
+    report["bytes"] = {
+        "archives": _archive_bytes(data) if data is not None and data.archives is not None else 0,
+        "read": data.bytes_read if data is not None else 0,
+        "written": patch_bytes,
+        "written_uncompressed": patch_file_bytes}
+    # The main process's peak since it started, and the largest peak of this build's map worker processes
+    report["peak_rss"] = game_info.peak_rss if game_info is not None and game_info.peak_rss is not None \
+        else get_peak_rss()
+    report["worker_peak_rss"] = game_info.worker_peak_rss if game_info is not None else None
+    return report
+
+
+def _write_report(args, report: dict, tracing: bool):
+    if tracing:
+        report["counters"] = tracer.totals()
+        if args.trace is not None:
+            tracer.export_chrome(args.trace)
+        if args.trace_summary or len(args.profile) > 0 or len(args.tracemalloc) > 0:
+            print(tracer.summary(), file=sys.stderr)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.report is None:
+        print(text, flush=True)
+    else:
+        with open(args.report, "w", encoding="utf8") as fp:
+            fp.write(text + "\n")
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    log_options = {"filename": args.log, "filemode": "w", "encoding": "utf_16"} if args.log else {"stream": sys.stderr}
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s", **log_options)
+
+    tracing = args.trace is not None or args.trace_summary or len(args.profile) > 0 or len(args.tracemalloc) > 0
+    if tracing:
+        tracer.enable(args.profile, args.tracemalloc)
+    if not args.watch:
+        report = run(args)
+        _write_report(args, report, tracing)
+        return 0 if report["ok"] else 1
+
+    # The watcher takes its snapshot first, so archives changing during the first build are picked up after it
+    watcher = ArchiveWatcher(args.h5_path, debounce=args.debounce, interval=args.poll_interval)
+    session = new_session(args)
+    report = run(args, session)
+    _write_report(args, report, tracing)
+    try:
+        while True:
+            changed = watcher.wait()
+            logging.warning("发现%d个压缩文件有变化，更新补丁……", len(changed))
+            for i in sorted(changed):
+                logging.info("  %s", i)
+            report = run(args, session, changed)
+            _write_report(args, report, tracing)
+    except KeyboardInterrupt:
+        logging.warning("停止监视")
+    finally:
+        watcher.close()
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class CreatureInfo:
+    town: str
+    cost: int
+    text: str
+    tier: int
+    upgrades: tuple[str, str]
+
+
+def _lua_format(value):
+    # Numbers and CREATURE_/TOWN_ constants are written as they are, anything else as a string
+    if isinstance(value, int) or value.startswith("CREATURE_") or value.startswith("TOWN_"):
+        return "    [{}] = {},"
+    return "    [{}] = \"{}\","
+
+
+class CreatureTable:
+    # The creatures with a name, as columns sorted once by town value, tier, grade and id, the order the Lua tables
+    # list them in. grades says 1 or 2 for the creatures some upgrade line names as its first or second upgrade,
+    # 0 for the rest; a creature several lines name keeps the grade of the last one, in add order.
+    def __init__(self):
+        self.infos = {}
+        self.upgrade_lines = []
+
+    def add(self, creature_id: str, info: CreatureInfo):
+        self.infos[creature_id] = info
+        if len(info.upgrades) > 0:
+            up1, up2 = info.upgrades
+            self.upgrade_lines.append((creature_id, up1, up2))
+
+    def __len__(self):
+        return len(self.infos)
+
+    def build(self, town_values: dict[str, int]):
+        grades = {}
+        for ungraded, up1, up2 in self.upgrade_lines:
+            grades[ungraded] = 0
+            grades[up1] = 1
+            grades[up2] = 2
+
+        keys = {k: (town_values[v.town], v.tier, grades.get(k, 0), k) for k, v in self.infos.items()}
+        self.ids = sorted(self.infos, key=keys.__getitem__)
+        self.position = {k: i for i, k in enumerate(self.ids)}
+        infos = [self.infos[i] for i in self.ids]
+        self.texts = [i.text for i in infos]
+        self.costs = [i.cost for i in infos]
+        self.tiers = [i.tier for i in infos]
+        self.towns = [i.town for i in infos]
+        self.grades = [grades.get(i, 0) for i in self.ids]
+
+        # Upgrade lines of named creatures in table order, ties kept in add order
+        self.ungraded = sorted((i for i in self.upgrade_lines if i[0] in self.position),
+                               key=lambda x: keys[x[0]][:3])
+        # (upgraded, ungraded) once per pair whose upgraded creature is named, ties by ids
+        pairs = {(up, line[0]) for line in self.upgrade_lines for up in line[1:] if up in self.position}
+        self.upgraded = sorted(pairs, key=lambda x: (keys[x[0]][:3], x))
+        return self
+
+    def lua(self):
+        # Every table of the creature info script in one pass over the sorted columns
+        lines = []
+
+        def _emit(var_name: str, ids, values):
+            lines.append("{} = {{".format(var_name))
+            if len(values) > 0:
+                format_string = _lua_format(values[0])
+                lines.extend(format_string.format(i, j) for i, j in zip(ids, values))
+            lines.append("}")
+            lines.append("")
+
+        _emit("CREATURE2TEXT", self.ids, self.texts)
+        _emit("CREATURE2COST", self.ids, self.costs)
+        _emit("CREATURE2TIER", self.ids, self.tiers)
+        _emit("CREATURE2TOWN", self.ids, self.towns)
+        _emit("CREATURE2GRADE", self.ids, self.grades)
+        _emit("CREATURE_UPGRADE2UNGRADED", [i for i, _ in self.upgraded], [i for _, i in self.upgraded])
+        lines.append("CREATURE_UNGRADE2UPGRADED = {[1] = {}, [2] = {}}")
+        lines.append("")
+        _emit("CREATURE_UNGRADE2UPGRADED[1]", [i[0] for i in self.ungraded], [i[1] for i in self.ungraded])
+        _emit("CREATURE_UNGRADE2UPGRADED[2]", [i[0] for i in self.ungraded], [i[2] for i in self.ungraded])
+        return "\n".join(lines)
@@ -1,17 +1,35 @@
 import logging
 import os
+from io import BytesIO
+from xml.sax.saxutils import escape
 import xml.etree.ElementTree as ET
-from collections import namedtuple
+from collections import namedtuple, deque
 from copy import deepcopy
-from time import time
+from time import time, perf_counter
 from zipfile import BadZipFile, ZipFile, ZIP_DEFLATED
 from threading import Lock
-from tempfile import NamedTemporaryFile
-from dataclasses import dataclass
-import sqlite3
-import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+import re
+import zlib
+import sys
+import multiprocessing
 
 from persistence import per
+from lru import BudgetLRU
+from zip_pool import ZipHandlePool
+from zip_recovery import RecoveredArchive
+from root_tag_index import RootTagIndex
+import xml_edit
+from xml_sniff import SNIFF_SIZE, sniff_root_tag, scan_values, find_values
+from manifest_cache import ManifestCache
+from manifest_entry import ManifestEntry, kind_of
+from manifest_classifier import ManifestClassifier
+from creature_table import CreatureInfo, CreatureTable
+from layered_vfs import LayeredVFS, Layer, Provider
+from patch_index import PatchIndex
+from patch_writer import PatchWriter, patch_date_time
+from progress import ProgressChannel
+from tracing import tracer
 
 
 # Global and game info
@@ -19,11 +37,18 @@ MapsStatusClass = namedtuple("MapsStatusClass", ["all_heroes", "all_spells_artef
 MapsStatusNames = ("全英雄Mod", "全魔法全宝物Mod", "种族能力增强Mod")
 HeroesStatusClass = namedtuple("HeroesStatusClass", ["racial_ability_boost", ])
 CreatureInfoClass = namedtuple("CreatureInfoClass", ["name", "cost"])
+MapXdbInfo = namedtuple("MapXdbInfo", ["zip_name", "size"])
+MapTagRecord = namedtuple("MapTagRecord", ["zip_name", "map_xdb_name"])
+CreatureRecord = namedtuple("CreatureRecord", ["obj", "obj_zip", "visual", "visual_zip", "info"])
+# perf_counter() when a map transform began, seconds spent parsing, transforming and serializing it, and the pid
+# of the process that did it. The streaming engine interleaves the three and counts all of it as transform.
+MapTimings = namedtuple("MapTimings", ["start", "parse", "transform", "serialize", "pid", "peak_rss"])
 HeroesStatusNames = ("种族能力增强mod", )
 PATCH_FILE_NAME = "TTBereinMergedPatch.h5u"
 MAPSCRIPT_XDB = "MapScript.xdb"
 MAPSCRIPT_LUA = "MapScript.lua"
 MAPSCRIPT_HREF = "MapScript.xdb#xpointer(/Script)"
+SPLICE_TAG = "TTBereinSplice"
 _SPEC_INFO_VALUE = namedtuple("_SPEC_INFO_VALUE", ["script", "var"])
 SPECIALIZATION_INFO = {
     "HERO_SPEC_DARK_ACOLYTE": _SPEC_INFO_VALUE("scripts/RacialAbilityBoost/RacialAbilityBoostDarkAcolytes.lua",
@@ -51,160 +76,436 @@ def remove_merged_patch():
     return merged_patch, False
 
 
-@dataclass(frozen=True)
-class CreatureInfo:
-    town: str
-    cost: int
-    text: str
-    tier: int
-    upgrades: tuple[str, str]
+def get_peak_rss():
+    # Peak resident memory of this process in bytes since it started, None where the platform can't tell
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class _ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                    ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+        return None
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# The Event a running build is cancelled with, set per process: GameInfo.work sets it in its own process and
+# the map worker processes get it through _set_cancel_event as their initializer. The engines poll it between
+# chunks of parsing, transforming and serializing so a cancel never waits for a whole map.
+_cancel_event = None
+_CANCEL_CHUNK = 1 << 20
+# Map worker processes start from a fresh interpreter, as they always do on Windows. A fork would copy this
+# process with the scan, compression and progress threads' locks in whatever state they happen to be.
+_MP_CONTEXT = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                                          else "spawn")
+
+
+def _set_cancel_event(event):
+    global _cancel_event
+    _cancel_event = event
+
+
+def _check_cancelled():
+    if _cancel_event is not None and _cancel_event.is_set():
+        raise InterruptedError
+
+
+class _CancellableParts(list):
+    # ElementTree.write target that collects the serialized pieces and checks for a cancel every CHECK_EVERY of them
+    CHECK_EVERY = 1 << 14
+
+    def write(self, text):
+        self.append(text)
+        if len(self) % _CancellableParts.CHECK_EVERY == 0:
+            _check_cancelled()
+
+
+def _parse_map(map_data: bytes):
+    # ET.fromstring, fed a chunk at a time
+    parser = ET.XMLParser()
+    view = memoryview(map_data)
+    for i in range(0, len(view), _CANCEL_CHUNK):
+        _check_cancelled()
+        parser.feed(view[i:i + _CANCEL_CHUNK])
+    return parser.close()
+
+
+def _serialize_map(map_et: ET.Element):
+    # Same bytes as ET.tostring(map_et, short_empty_elements=True, encoding='utf8', method='xml')
+    parts = _CancellableParts()
+    parts.write("<?xml version='1.0' encoding='utf8'?>\n")
+    ET.ElementTree(map_et).write(parts, encoding="unicode", short_empty_elements=True, method="xml")
+    return "".join(parts).encode("utf8")
+
+
+class HeroRecord:
+    # The parts of an AdvMapHeroShared xdb _work_heroes looks at, kept instead of its tree for the whole session.
+    # Missing elements read as None or empty. The tree is parsed again from file_name only for heroes that change.
+    __slots__ = ("file_name", "zip_name", "internal_name", "hero_class", "skills", "perks", "spells",
+                 "specialization")
+
+    def __init__(self, file_name: str, zip_name: str, hero_et: ET.Element):
+        self.file_name = file_name
+        self.zip_name = zip_name
+        self.internal_name = hero_et.findtext("InternalName")
+        self.hero_class = hero_et.findtext("Class")
+        self.specialization = hero_et.findtext("Specialization")
+        # Primary skill plus the skills of Editable, what perk swaps depend on
+        primary = hero_et.find("PrimarySkill")
+        skills = [] if primary is None else [i.text for i in primary if i.tag == "SkillID"]
+        skills.extend(i.findtext("SkillID") for i in hero_et.iterfind("Editable/skills/*"))
+        self.skills = frozenset(skills)
+        self.perks = tuple(i.text for i in hero_et.iterfind("Editable/perkIDs/*"))
+        self.spells = tuple(i.text for i in hero_et.iterfind("Editable/spellIDs/*"))
 
 
 class RawData:
     DIRS = {"data": ".pak", "UserMods": ".h5u", "Maps": ".h5m"}
     PREFIX_FILTERS = ("maps/", "ttberein/", "mapobjects/", "scripts/", "gamemechanics/" )
     SUFFIX_FILTERS = (".xdb", ".chk", ".lua")
+    # PREFIX_FILTERS and SUFFIX_FILTERS as one case insensitive match
+    FILTER = re.compile("(?:{}).*(?:{})\\Z".format("|".join(re.escape(i) for i in PREFIX_FILTERS),
+                                                   "|".join(re.escape(i) for i in SUFFIX_FILTERS)),
+                        re.IGNORECASE | re.DOTALL)
 
-    def __init__(self, h5_path: str):
+    def __init__(self, h5_path: str, use_cache: bool = True, scan_workers: int = None, max_open_archives: int = 64,
+                 progress: ProgressChannel = None, keep_scanned: bool = False):
         self.h5_path = h5_path
-        self.zip_q = None
-        self.manifest = None
+        self.scan_workers = min(32, (os.cpu_count() or 1) + 4) if scan_workers is None else scan_workers
+        self.archives = None
+        self.zip_pool = ZipHandlePool(max_open_archives, RawData.FILTER.match)
+        self.recovered = {}
+        self.recovered_lock = Lock()
+        self.vfs = None
+        self.buckets = None
+        self.newest_date_time = None
+        # {archive: filtered entries} of the last scan, kept with keep_scanned only. refresh then rescans just the
+        # archives it drops from here, without it every archive is read again.
+        self.keep_scanned = keep_scanned
+        self.scanned = {}
+        self.cache = ManifestCache((RawData.PREFIX_FILTERS, RawData.SUFFIX_FILTERS)) if use_cache else None
+        self.tag_index = RootTagIndex() if use_cache else None
         self.tree = None
         self.curr_stage = "估计中"
         self.curr_prog = 0
         self.total_prog = 1
+        self.stage_times = {}
+        self.bytes_read = 0
         self.lock = Lock()
+        self.progress = progress
 
     def run(self):
-        self._gen_stats()
-        self._build_zip_list()
+        with tracer.span("scan"):
+            self._gen_stats()
+            self._build_zip_list()
+
+    def refresh(self, changed):
+        # Scan again after the archives in changed were added, rewritten or removed. Only those are read, the
+        # VFS and the buckets are rebuilt from the entries kept for the rest.
+        for i in changed:
+            self.scanned.pop(i, None)
+            self.zip_pool.invalidate(i)
+            with self.recovered_lock:
+                self.recovered.pop(i, None)
+        self.archives = None
+        try:
+            self.run()
+        finally:
+            self.zip_pool.close()
+
+    @staticmethod
+    def list_archives(h5_path: str):
+        # (folder, file name, full path) of every archive a scan reads, in scan order
+        archives = []
+        for folder, file_suf in RawData.DIRS.items():
+            fullpath = os.path.join(h5_path, folder)
+            if os.path.isdir(fullpath):
+                with os.scandir(fullpath) as it:
+                    archives.extend((folder, i.name, i.path) for i in it
+                                    if i.name.lower().endswith(file_suf) and i.is_file()
+                                    and PATCH_FILE_NAME.lower() not in i.name.lower())
+        return archives
 
     def _gen_stats(self):
+        # The one directory pass of the scan, it counts the archives and keeps them for _build_zip_list
+        if not os.path.isdir(os.path.join(self.h5_path, "data")):
+            raise ValueError(f"\"{self.h5_path}\"中没有找到\"data\"，\n请检查是否是正确的英雄无敌5安装文件夹")
+        archives = RawData.list_archives(self.h5_path)
         with self.lock:
-            self.total_prog = 0
+            self.archives = archives
+            self.total_prog = len(archives) + 1
+        self._advance()
 
-        for folder, file_suf in RawData.DIRS.items():
-            fullpath = os.path.join(self.h5_path, folder)
-            if os.path.isdir(fullpath):
-                self.total_prog += len(tuple(f for f in os.listdir(fullpath)
-                                             if f.lower().endswith(file_suf)
-                                             and PATCH_FILE_NAME.lower() not in f.lower())) + 1
-            elif folder.lower() == "data":
-                raise ValueError(f"\"{self.h5_path}\"中没有找到\"{folder}\"，\n请检查是否是正确的英雄无敌5安装文件夹")
+    @staticmethod
+    def _filter_infolist(infolist):
+        match = RawData.FILTER.match
+        return [j for j in infolist if match(j.filename) and not j.is_dir()]
+
+    def _scan_zip(self, fullname: str):
+        # Returns the filtered (filename, date_time) entries of the archive, None if it is not a valid archive
+        if self.cache is not None:
+            fingerprint = ManifestCache.fingerprint(fullname)
+            hit, entries = self.cache.lookup(fullname, fingerprint)
+            if hit:
+                return entries
+
+        try:
+            zip_file_fp = ZipFile(fullname)
+            infos = RawData._filter_infolist(zip_file_fp.infolist())
+            entries = [(i.filename, i.date_time) for i in infos]
+            if len(entries) > 0:
+                self.zip_pool.add_directory(fullname, zip_file_fp, infos)
+            else:
+                zip_file_fp.close()
+        except BadZipFile:
+            # The central directory is broken, whatever local file headers survive are still usable
+            recovered = self._get_recovered(fullname)
+            entries = [(i.filename, i.date_time) for i in RawData._filter_infolist(recovered.infolist())] \
+                if recovered.scan() > 0 else None
+            if entries is not None:
+                logging.warning("  “%s”的目录已损坏，从本地文件头恢复了%d个相关文件", fullname, len(entries))
+
+        if self.cache is not None:
+            self.cache.store(fullname, fingerprint, entries)
+        return entries
+
+    def _scan_zip_with_progress(self, fullname: str):
+        with tracer.span("scan_zip", "archive", archive=fullname):
+            entries = self._scan_zip(fullname)
+        self._advance(1)
+        return entries
 
     def _build_zip_list(self):
-        self.manifest = {}
-        self.zip_q = {}
+        self.vfs = None
         self.curr_prog = 0
         prev_timeit = time()
-        logging.info(f"开始对\"{self.h5_path}\"的所有游戏数据文件扫描……")
-
-        zfs = []
+        logging.info("开始对\"%s\"的所有游戏数据文件扫描……", self.h5_path)
+
+        if self.archives is None:
+            self._gen_stats()
+
+        to_scan = [i for i in self.archives if i[2] not in self.scanned]
+        if len(to_scan) < len(self.archives):
+            self._advance(len(self.archives) - len(to_scan))
+            logging.info("  沿用上次扫描的%d个压缩文件", len(self.archives) - len(to_scan))
+        num_workers = min(self.scan_workers, len(to_scan))
+        if num_workers > 1:
+            self._advance(stage=f"正在用{num_workers}个线程扫描{len(to_scan)}个压缩文件")
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = list(executor.map(self._scan_zip_with_progress, (i[2] for i in to_scan)))
+        else:
+            results = []
+            for folder, _, fullname in to_scan:
+                self._advance(stage=f"正在扫描\"{folder}\"文件夹")
+                results.append(self._scan_zip_with_progress(fullname))
+        self.scanned.update((i[2], entries) for i, entries in zip(to_scan, results))
+        results = [self.scanned[i[2]] for i in self.archives]
+        self.scanned = {i[2]: entries for i, entries in zip(self.archives, results)} if self.keep_scanned else {}
+
+        # Layer priorities follow the directory order, so the precedence among equal date_times is the same as
+        # a serial scan
+        layers = []
         zis = []
-        self.zip_q = {}
-        for folder, file_suf in RawData.DIRS.items():
-            fullpath = os.path.join(self.h5_path, folder)
-            if not os.path.isdir(fullpath):
-                continue
+        for priority, ((folder, f, fullname), entries) in enumerate(zip(self.archives, results)):
+            if entries is None:
+                logging.info("  %s中的%s并不是有效的压缩文件", folder, f)
+            elif len(entries) > 0:
+                layers.append(Layer(priority, folder, fullname))
+                zis.append(entries)
+
+        self._advance(1, "生成文件清单……")
+        zs = sorted([(filename.lower(), date_time, layer.priority, filename, layer.zip_name)
+                     for layer, i in zip(layers, zis) for filename, date_time in i], key=lambda x: x[:3])
+        self.newest_date_time = max((i[1] for i in zs), default=None)
+        self.vfs = LayeredVFS(layers)
+        self.buckets = ManifestClassifier()
+        losers = []
+        for n, (lower_name, date_time, _, true_name, zip_name) in enumerate(zs):
+            # The last of the entries sharing a name wins, it shadows the ones before it
+            if n + 1 == len(zs) or zs[n + 1][0] != lower_name:
+                entry = ManifestEntry(true_name, zip_name, kind_of(zip_name))
+                self.vfs.add(lower_name, entry, losers)
+                self.buckets.route(lower_name, entry)
+                losers = []
+            else:
+                losers.append(Provider(zip_name, date_time))
+        if self.cache is not None:
+            self.cache.save(set(i[2] for i in self.archives))
+            logging.info("  清单缓存命中%d个压缩文件，重新扫描%d个", self.cache.hits, self.cache.misses)
+        self.stage_times["scan"] = time() - prev_timeit
+        logging.warning("游戏数据文件信息扫描完毕，发现%d个相关文件，用时%.2f秒。", len(layers), self.stage_times['scan'])
+
+    def get_file(self, target: str):
+        zip_name = None
+        try:
+            true_name, zip_name = self.vfs[target]
+            if self._known_damaged(zip_name) is not None:
+                result = self._recover_file(zip_name, true_name)
+                if result is None:
+                    logging.warning("恢复手段也无法读取来自“%s”的“%s”……", zip_name, target)
+                return result
+            with self.zip_pool.lease(zip_name) as zf:
+                result = zf.read(true_name)
             with self.lock:
-                self.curr_stage = f"正在扫描\"{folder}\"文件夹"
-            for f in os.listdir(fullpath):
+                self.bytes_read += len(result)
+            tracer.count("bytes_decompressed", len(result), zip_name)
+            return result
+        except (BadZipFile, zlib.error):
+            logging.warning("来自“%s”的“%s”无法正常读取，尝试从本地文件头恢复……", zip_name, target)
+            result = self._recover_file(zip_name, true_name)
+            if result is None:
+                logging.warning("恢复手段也无法读取来自“%s”的“%s”……", zip_name, target)
+            return result
+        except:
+            return None
 
-                fullname = os.path.join(fullpath, f)
-                if os.path.isfile(fullname) and fullname.lower().endswith(file_suf) and \
-                    PATCH_FILE_NAME.lower() not in f.lower():
-                    zfs.append(fullname)
-                    try:
-                        zip_file_fp = ZipFile(fullname)
-                        self.zip_q[fullname] = zip_file_fp
-                        zis.append(zip_file_fp.infolist())
-                    except BadZipFile:
-                        logging.info(f"  {folder}中的{f}并不是有效的压缩文件")
+    def _get_recovered(self, zip_name: str):
+        # recovered only holds archives whose central directory is broken. Once one is found, every later read of
+        # it goes straight to its recovery reader instead of parsing the directory again.
+        with self.recovered_lock:
+            if zip_name not in self.recovered:
+                self.recovered[zip_name] = RecoveredArchive(zip_name)
+            return self.recovered[zip_name]
 
-                    with self.lock:
-                        self.curr_prog += 1
+    def _known_damaged(self, zip_name: str):
+        with self.recovered_lock:
+            return self.recovered.get(zip_name)
 
-        with self.lock:
-            self.curr_stage = f"生成文件清单……"
-            self.curr_prog += 1
-        zs = sorted([(j.filename.lower(), j.filename, j.date_time, f) for i, f in zip(zis, zfs) if len(i) > 0 for j in i
-                     if any(j.filename.lower().startswith(k) for k in RawData.PREFIX_FILTERS) \
-                     and any(j.filename.lower().endswith(k) for k in RawData.SUFFIX_FILTERS)
-                     and not j.is_dir()],
-                    key=lambda x:(x[0], x[2]))
-        self.manifest = {i[0]: (i[1], i[3]) for i in zs}
-        logging.warning(f"游戏数据文件信息扫描完毕，发现{len(self.zip_q)}个相关文件，用时{time() - prev_timeit:.2f}秒。")
-
-    def listdir(self, target: str, zips_to_exclude=set()):
-        target = target.lower()
-        if not target.endswith("/"):
-            target = target + "/"
-        if target.startswith("/"):
-            target = target[1:]
-
-        all_dirs = set()
-        all_files = {}
-        for filename, (true_name, zip_name) in self.manifest.items():
-            if zip_name[-4:].lower() in zips_to_exclude:
-                continue
-            if filename.startswith(target):
-                remaining = filename[len(target):]
-                if "/" not in remaining:
-                    all_files[filename] = (true_name, zip_name) 
-                else:
-                    all_dirs.add(target + remaining.split("/")[0])
+    def _recover_file(self, zip_name: str, true_name: str):
+        try:
+            recovered = self._known_damaged(zip_name)
+            if recovered is not None:
+                return recovered.read(true_name)
+            try:
+                header_offset = self.zip_pool.directory(zip_name).getinfo(true_name).header_offset
+            except BadZipFile:
+                return self._get_recovered(zip_name).read(true_name)
+            except KeyError:
+                header_offset = None
+            # Only this entry is damaged, its local header is found through the intact directory
+            return RecoveredArchive(zip_name).read(true_name, header_offset)
+        except OSError:
+            return None
 
-        return sorted(list(all_dirs)), sorted(list(all_files.values()))
+    def open_file(self, target: str):
+        # The stream stays valid after the pool closes the handle it came from
+        true_name, zip_name = self.vfs[target]
+        try:
+            if self._known_damaged(zip_name) is not None:
+                raise BadZipFile(zip_name)
+            with self.zip_pool.lease(zip_name) as zf:
+                return zf.open(true_name)
+        except BadZipFile:
+            result = self._recover_file(zip_name, true_name)
+            if result is None:
+                raise
+            return BytesIO(result)
+
+    def get_root_tag(self, target: str):
+        # Root element of an xml entry, remembered across runs by archive, entry name and CRC32
+        zinfo = self.get_info(target)
+        if zinfo is None:
+            return None
+        if zinfo.CRC is None:
+            return self._sniff_root_tag(target)
+        key = (self.get_zipname(target), zinfo.filename, zinfo.CRC)
+        tag = RootTagIndex.UNKNOWN if self.tag_index is None else self.tag_index.get(key)
+        if tag is RootTagIndex.UNKNOWN:
+            tag = self._sniff_root_tag(target)
+            if self.tag_index is not None:
+                self.tag_index.put(key, tag)
+        return tag
+
+    def _sniff_root_tag(self, target: str):
+        try:
+            with self.open_file(target) as fp:
+                tag = sniff_root_tag(fp.read(SNIFF_SIZE))
+            if tag is not None:
+                return tag
+        except (BadZipFile, KeyError, OSError, zlib.error):
+            pass
+
+        content = self.get_file(target)
+        if content is None:
+            return None
+        try:
+            return ET.fromstring(content).tag
+        except ET.ParseError:
+            return None
 
-    def walk(self, target: str, zips_to_exclude=set()):
-        target = target.lower()
-        if not target.endswith("/"):
-            target = target + "/"
-        if target.startswith("/"):
-            target = target[1:]
+    def peek_values(self, target: str, queries):
+        # Values of a few elements/attributes, see xml_sniff.scan_values for the queries. The entry is streamed
+        # and decompressed only as far as needed, a full read and parse is the fallback for damaged archives.
+        # Returns None if the entry can't be read, raises ET.ParseError if it is not valid xml.
+        try:
+            with self.open_file(target) as fp:
+                return scan_values(fp, queries)
+        except (BadZipFile, KeyError, OSError, zlib.error):
+            pass
 
-        all_files = {}
-        for filename, (true_name, zip_name) in self.manifest.items():
-            if zip_name[-4:].lower() in zips_to_exclude:
-                continue
-            if filename.startswith(target):
-                all_files[filename] = (true_name, zip_name) 
+        content = self.get_file(target)
+        if content is None:
+            return None
+        return find_values(ET.fromstring(content), queries)
 
-        return sorted(list(all_files.values()))
+    def save_tag_index(self):
+        if self.tag_index is not None:
+            self.tag_index.save(set(i[2] for i in self.archives))
+            logging.info("  根标签索引命中%d个文件，重新识别%d个", self.tag_index.hits, self.tag_index.misses)
 
-    def get_file(self, target: str):
+    def get_info(self, target: str):
         try:
-            zip_name = self.get_zipname(target)
-            return self.zip_q[zip_name].read(target)
+            true_name, zip_name = self.vfs[target]
+        except KeyError:
+            return None
+        try:
+            if self._known_damaged(zip_name) is not None:
+                raise BadZipFile(zip_name)
+            return self.zip_pool.directory(zip_name).getinfo(true_name)
         except BadZipFile:
-            logging.warning(f"来自“{zip_name}”的“{target}”无法正常读取，尝试另外手段……")
-            tmp_path = os.path.dirname(NamedTemporaryFile().name)
-            cmd = "{} e {} -i!*{} -y -o{}".format(per.get_7za(), zip_name, target, tmp_path)
-            tmp_file = os.path.join(tmp_path, os.path.basename(target))
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            proc.communicate()
-            if proc.returncode == 0:
-                try:
-                    result = open(tmp_file).read()
-                except FileNotFoundError:
-                    logging.warning(f"另外手段也无法读取来自“{zip_name}”的“{target}”……")
-                    return None
-                try:
-                    os.remove(tmp_file)
-                except:
-                    pass
-                return result
-            else:
+            try:
+                return self._get_recovered(zip_name).getinfo(true_name)
+            except (KeyError, OSError):
                 return None
         except:
             return None
 
+    def get_fingerprint(self, target: str):
+        # None if the entry's CRC is unknown, a patch index never reuses what was built from such an entry
+        zinfo = self.get_info(target)
+        return None if zinfo is None or zinfo.CRC is None else (zinfo.CRC, zinfo.file_size)
+
     def get_zipname(self, target: str):
         try:
-            return self.manifest[target.lower()][1]
+            return self.vfs[target].zip_name
         except:
             return None
 
+    def _advance(self, step: int = 0, stage: str = None):
+        # The channel gets the new state after the lock is released, it never makes a scan thread wait
+        with self.lock:
+            self.curr_prog += step
+            if stage is not None:
+                self.curr_stage = stage
+            stage, fraction = self.curr_stage, self.curr_prog / self.total_prog
+        if self.progress is not None:
+            self.progress.publish("scan", stage, fraction)
+
     def get_progress(self):
         with self.lock:
             return self.curr_prog / self.total_prog
@@ -218,66 +519,490 @@ class RawData:
         return 2.80
 
 
+def _empty_element_by_tag(et: ET.Element, tag_to_empty):
+    to_remove_et = et.find(tag_to_empty)
+    to_remove_et_i = list(et).index(to_remove_et)
+    et.remove(to_remove_et)
+    et.insert(to_remove_et_i, ET.Element(tag_to_empty))
+
+
+def _union_items_btw_et_and_set(et1: ET.Element, set2: set[str]):
+    # et1 will be modified
+    set1 = set(i.text for i in et1)
+    if len(set1) > 0:
+        for i in sorted(set2):
+            if i not in set1:
+                ele = ET.Element("Item")
+                ele.text = i
+                et1.append(ele)
+
+
+def _add_missing_towns_and_arti(map_et: ET.Element, xml_name: str):
+    # The missing RAB towns and artificer artefacts are spliced in as serialized fragments by _splice_fragments,
+    # a placeholder element keeps their place in "objects" until then
+    towns = set()
+    artis = set()
+
+    objects_et = map_et.find("objects")
+    for n, i in enumerate(objects_et.findall("Item")):
+        if n % 4096 == 0:
+            _check_cancelled()
+        adv_town_et = i.find("AdvMapTown")
+        if adv_town_et is not None:
+            towns.add(adv_town_et.find("Name").text)
+        else:
+            adv_arti_et = i.find("AdvMapArtifact")
+            if adv_arti_et is not None:
+                adv_arti_name = adv_arti_et.find("Name").text
+                if adv_arti_name is not None and adv_arti_name != "":
+                    artis.add(adv_arti_name)
+
+    fragments = [per.get_rab_fragment(rab) for rab in per.rab_xdbs if rab not in towns]
+    fragments.extend(per.get_artificer_artefact_fragment(arti, xml_name) for arti in per.artificer_artefact_names
+                     if arti not in artis)
+    if len(fragments) > 0:
+        objects_et.append(ET.Element(SPLICE_TAG))
+    return fragments
+
+
+def _splice_fragments(map_bytes: bytes, fragments: list):
+    if len(fragments) == 0:
+        return map_bytes
+    separator = "\n" + "    " * per.OBJECTS_ITEM_LEVEL
+    return map_bytes.replace(f"<{SPLICE_TAG} />".encode("utf8"), separator.join(fragments).encode("utf8"), 1)
+
+
+def _enable_all_spells_artefacts(map_et: ET.Element, cat: str):
+    def _sub_process(tag, all_set):
+        if not (cat == "scenario" and tag == "artifactIDs"):
+            if cat == "nochange":
+                pass
+            elif cat in ("scenario", "singlemissions"):
+                _union_items_btw_et_and_set(map_et.find(tag), all_set)
+            else:
+                _empty_element_by_tag(map_et, tag)
+
+    params = (("spellIDs", per.all_spells_set), ("artifactIDs", per.all_artefacts_set))
+    for param1, param2 in params:
+        _sub_process(param1, param2)
+
+
+def _enable_all_heroes(map_et: ET.Element):
+    _empty_element_by_tag(map_et, "AvailableHeroes")
+
+
+def _enable_map_script(map_et: ET.Element):
+    return _enable_map_script_et(map_et.find("MapScript"))
+
+
+def _enable_map_script_et(script_et: ET.Element):
+    if script_et is not None and ("href" not in script_et.attrib or script_et.attrib["href"] == ""):
+        script_et.attrib["href"] = MAPSCRIPT_HREF
+        return True
+    else:
+        return False
+
+
+def _transform_map(xml_name: str, cat: str, options: MapsStatusClass, map_data: bytes):
+    # Runs in the map worker processes as well, so it only touches its arguments and the resources in per.
+    # Returns (xml_name, serialized map or None if it can't be parsed, whether MapScript files are needed, MapTimings)
+    start = perf_counter()
+    try:
+        map_et = _parse_map(map_data)
+    except ET.ParseError:
+        return xml_name, None, False, MapTimings(start, perf_counter() - start, 0.0, 0.0, os.getpid(), get_peak_rss())
+    parsed = perf_counter()
+
+    add_script = False
+    fragments = []
+    if options.all_heroes is True and cat != "nochange":
+        _enable_all_heroes(map_et)
+    if options.all_spells_artefacts is True:
+        _enable_all_spells_artefacts(map_et, cat)
+    if options.racial_ability_boost is True:
+        fragments = _add_missing_towns_and_arti(map_et, xml_name)
+        add_script = _enable_map_script(map_et)
+
+    transformed = perf_counter()
+    ET.indent(map_et, space="    ", level=0)
+    _check_cancelled()
+    result = _splice_fragments(_serialize_map(map_et), fragments)
+    return xml_name, result, add_script, MapTimings(start, parsed - start, transformed - parsed,
+                                                    perf_counter() - transformed, os.getpid(),
+                                                    get_peak_rss())
+
+
+class _MapStreamTransformer:
+    # One forward pass over a map xdb with bounded memory: only the root and "objects" are kept open, every other
+    # element is built, transformed, serialized at its indentation level and dropped as soon as it ends.
+    # The output is the same as ET.indent + ET.tostring over the whole tree.
+    INDENT = "    "
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, cat: str, options: MapsStatusClass, out, xml_name: str):
+        self.cat = cat
+        self.xml_name = xml_name
+        self.options = options
+        self.out = out
+        self.parts = []
+        # ElementTree.write only needs a write method, appending to a list skips a codec call per piece
+        self.write = self.parts.append
+        self.add_script = False
+        self.towns = set()
+        self.artis = set()
+        self.done_tags = set()
+        # Per open streamed element: [element, level, start tag written, previous child or None for injected]
+        self.streamed = []
+
+    def _flush(self):
+        self.out.write("".join(self.parts).encode("utf8"))
+        self.parts.clear()
+
+    @staticmethod
+    def _separator(text, level):
+        if text and text.strip():
+            return escape(text)
+        return "\n" + _MapStreamTransformer.INDENT * level
+
+    def _serialize(self, et: ET.Element, level: int):
+        tail = et.tail
+        et.tail = None
+        ET.indent(et, space=_MapStreamTransformer.INDENT, level=level)
+        ET.ElementTree(et).write(self, encoding="unicode", short_empty_elements=True, method="xml")
+        et.tail = tail
+
+    def _begin_child(self, parent_state):
+        parent, level, opened, prev_child = parent_state
+        if not opened:
+            head = ET.tostring(ET.Element(parent.tag, parent.attrib), short_empty_elements=False, encoding="unicode")
+            self.write(head[:-len(parent.tag) - 3])
+            parent_state[2] = True
+            self.write(_MapStreamTransformer._separator(parent.text, level + 1))
+        else:
+            self.write(_MapStreamTransformer._separator(prev_child.tail if prev_child is not None else None,
+                                                         level + 1))
+
+    def _end_streamed(self):
+        parent, level, opened, prev_child = self.streamed.pop()
+        if not opened:
+            self._serialize(parent, level)
+        else:
+            self.write(_MapStreamTransformer._separator(prev_child.tail if prev_child is not None else None, level))
+            self.write(f"</{parent.tag}>")
+
+    def _transform_top_child(self, et: ET.Element):
+        # Same changes as _enable_all_heroes, _enable_all_spells_artefacts and _enable_map_script, on the first
+        # child with each tag
+        tag = et.tag
+        if tag in self.done_tags:
+            return et
+        self.done_tags.add(tag)
+
+        if tag == "AvailableHeroes" and self.options.all_heroes is True and self.cat != "nochange":
+            return ET.Element(tag)
+        if tag in ("spellIDs", "artifactIDs") and self.options.all_spells_artefacts is True:
+            if not (self.cat == "scenario" and tag == "artifactIDs"):
+                if self.cat in ("scenario", "singlemissions"):
+                    _union_items_btw_et_and_set(et, per.all_spells_set if tag == "spellIDs" else per.all_artefacts_set)
+                elif self.cat != "nochange":
+                    return ET.Element(tag)
+        if tag == "MapScript" and self.options.racial_ability_boost is True:
+            self.add_script = _enable_map_script_et(et)
+        return et
+
+    def _collect_object(self, et: ET.Element):
+        if et.tag != "Item":
+            return
+        adv_town_et = et.find("AdvMapTown")
+        if adv_town_et is not None:
+            self.towns.add(adv_town_et.find("Name").text)
+        else:
+            adv_arti_et = et.find("AdvMapArtifact")
+            if adv_arti_et is not None:
+                adv_arti_name = adv_arti_et.find("Name").text
+                if adv_arti_name is not None and adv_arti_name != "":
+                    self.artis.add(adv_arti_name)
+
+    def _inject_objects(self, objects_state):
+        level = objects_state[1] + 1
+        fragments = [per.get_rab_fragment(rab, level) for rab in per.rab_xdbs if rab not in self.towns]
+        fragments.extend(per.get_artificer_artefact_fragment(arti, self.xml_name, level)
+                         for arti in per.artificer_artefact_names if arti not in self.artis)
+        for fragment in fragments:
+            self._begin_child(objects_state)
+            self.write(fragment)
+            objects_state[3] = None
+
+    def run(self, src):
+        parser = ET.XMLPullParser(events=("start", "end"))
+        depth = 0
+        self.write("<?xml version='1.0' encoding='utf8'?>\n")
+        while True:
+            _check_cancelled()
+            chunk = src.read(_MapStreamTransformer.CHUNK_SIZE)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            self._flush()
+            for event, et in parser.read_events():
+                if event == "start":
+                    depth += 1
+                    streamed_depth = len(self.streamed)
+                    if depth == streamed_depth + 1 and \
+                        (depth == 1 or (depth == 2 and et.tag == "objects" and "objects" not in self.done_tags)):
+                        if depth > 1:
+                            self.done_tags.add("objects")
+                            self._begin_child(self.streamed[-1])
+                        self.streamed.append([et, depth - 1, False, None])
+                    elif depth == streamed_depth + 1:
+                        self._begin_child(self.streamed[-1])
+                else:
+                    depth -= 1
+                    if depth == len(self.streamed) - 1:
+                        if et.tag == "objects" and depth == 1 and self.options.racial_ability_boost is True:
+                            self._inject_objects(self.streamed[-1])
+                        self._end_streamed()
+                        if depth > 0:
+                            self.streamed[-1][3] = et
+                            self.streamed[-1][0].remove(et)
+                    elif depth == len(self.streamed):
+                        parent_state = self.streamed[-1]
+                        if depth == 1:
+                            new_et = self._transform_top_child(et)
+                        else:
+                            self._collect_object(et)
+                            new_et = et
+                        self._serialize(new_et, depth)
+                        parent_state[3] = new_et
+                        parent_state[0].remove(et)
+            if not chunk:
+                break
+        self._flush()
+        return self.add_script
+
+
+def _stream_transform_map(xml_name: str, cat: str, options: MapsStatusClass, map_data):
+    # Streaming counterpart of _transform_map, map_data is either the bytes or a readable binary file object
+    start = perf_counter()
+    src = BytesIO(map_data) if isinstance(map_data, (bytes, bytearray)) else map_data
+    out = BytesIO()
+    try:
+        add_script = _MapStreamTransformer(cat, options, out, xml_name).run(src)
+    except ET.ParseError:
+        return xml_name, None, False, MapTimings(start, 0.0, perf_counter() - start, 0.0, os.getpid(), get_peak_rss())
+    return xml_name, out.getvalue(), add_script, MapTimings(start, 0.0, perf_counter() - start, 0.0, os.getpid(),
+                                                            get_peak_rss())
+
+
+_EDIT_MAP_REGIONS = ("AvailableHeroes", "spellIDs", "artifactIDs", "MapScript", "objects")
+_EDIT_MAP_TEXTS = ("objects/Item/AdvMapTown/Name", "objects/Item/AdvMapArtifact/Name", "spellIDs/*", "artifactIDs/*")
+
+
+def _edit_transform_map(xml_name: str, cat: str, options: MapsStatusClass, map_data: bytes):
+    # Same changes as _transform_map, spliced into the original bytes: everything outside the touched elements
+    # keeps its formatting and is only copied. Items added to spellIDs and artifactIDs come in sorted order.
+    start = perf_counter()
+    try:
+        regions, texts = xml_edit.locate(map_data, _EDIT_MAP_REGIONS, _EDIT_MAP_TEXTS, _check_cancelled)
+    except ET.ParseError:
+        return xml_name, None, False, MapTimings(start, perf_counter() - start, 0.0, 0.0, os.getpid(), get_peak_rss())
+    parsed = perf_counter()
+
+    edits = []
+    add_script = False
+
+    def _empty(tag):
+        region = regions.get(tag)
+        if region is not None:
+            edits.append((region.start, region.end, f"<{tag} />".encode("utf8")))
+
+    def _append_children(region, children, level):
+        # children go after the last child, with the whitespace that precedes the first one
+        separator = xml_edit.child_separator(map_data, region, b"\n" + b"    " * (level + 1))
+        if region.first_child is not None:
+            edits.append((region.last_child_end, region.last_child_end,
+                          b"".join(separator + i for i in children)))
+        else:
+            # No children yet, the whole element is rewritten around them
+            tag = xml_edit.start_tag(map_data, region)
+            if region.inner_start is None:
+                tag = tag[:-2].rstrip() + b">"
+            name = tag[1:].split(None, 1)[0].rstrip(b">")
+            edits.append((region.start, region.end, tag + b"".join(separator + i for i in children) +
+                          b"\n" + b"    " * level + b"</" + name + b">"))
+
+    if options.all_heroes is True and cat != "nochange":
+        _empty("AvailableHeroes")
+    if options.all_spells_artefacts is True:
+        for tag, all_set in (("spellIDs", per.all_spells_set), ("artifactIDs", per.all_artefacts_set)):
+            if cat == "nochange" or (cat == "scenario" and tag == "artifactIDs"):
+                continue
+            if cat in ("scenario", "singlemissions"):
+                existing = set(texts[tag + "/*"])
+                missing = sorted(all_set - existing)
+                if len(existing) > 0 and len(missing) > 0:
+                    _append_children(regions[tag], [f"<Item>{escape(i)}</Item>".encode("utf8") for i in missing], 1)
+            else:
+                _empty(tag)
+    if options.racial_ability_boost is True:
+        towns = set(texts["objects/Item/AdvMapTown/Name"])
+        artis = set(texts["objects/Item/AdvMapArtifact/Name"])
+        fragments = [per.get_rab_fragment(rab) for rab in per.rab_xdbs if rab not in towns]
+        fragments.extend(per.get_artificer_artefact_fragment(arti, xml_name) for arti in per.artificer_artefact_names
+                         if arti not in artis)
+        if len(fragments) > 0:
+            _append_children(regions["objects"], [i.encode("utf8") for i in fragments], per.OBJECTS_ITEM_LEVEL - 1)
+        region = regions.get("MapScript")
+        if region is not None:
+            tag = xml_edit.start_tag(map_data, region)
+            span = xml_edit.attribute_span(tag, "href")
+            if span is None:
+                name_end = region.start + 1 + len("MapScript")
+                edits.append((name_end, name_end, f' href="{MAPSCRIPT_HREF}"'.encode("utf8")))
+                add_script = True
+            elif span[0] == span[1]:
+                edits.append((region.start + span[0], region.start + span[1], MAPSCRIPT_HREF.encode("utf8")))
+                add_script = True
+    transformed = perf_counter()
+
+    _check_cancelled()
+    result = xml_edit.apply_edits(map_data, edits)
+    return xml_name, result, add_script, MapTimings(start, parsed - start, transformed - parsed,
+                                                    perf_counter() - transformed, os.getpid(),
+                                                    get_peak_rss())
+
+
+MAP_ENGINES = {"tree": _transform_map, "stream": _stream_transform_map, "edit": _edit_transform_map}
+_EDIT_HERO_REGIONS = ("Editable/spellIDs", "Editable/perkIDs", "Specialization", "SpecializationNameFileRef",
+                      "SpecializationDescFileRef", "SpecializationIcon")
+
+
+def _edit_hero(hero_data: bytes, hero_et: ET.Element):
+    # hero_et is the transformed tree of hero_data, only the touched elements whose content changed are
+    # serialized again and spliced into the original bytes
+    regions, _ = xml_edit.locate(hero_data, _EDIT_HERO_REGIONS)
+    edits = []
+    for path, region in regions.items():
+        et = hero_et.find(path)
+        if et is None:
+            continue
+        original = hero_data[region.start:region.end].decode("utf8")
+        new = xml_edit.serialize_element(et, path.count("/") + 1)
+        if not xml_edit.same_content(original, new):
+            edits.append((region.start, region.end, new.encode("utf8")))
+    return xml_edit.apply_edits(hero_data, edits)
+
+
+HERO_ENGINES = ("tree", "edit")
+
+
 class GameInfo:
-    def __init__(self):
+    MAP_CACHE_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, map_workers: int = None, map_engine: str = "tree", map_cache_bytes: int = MAP_CACHE_BYTES,
+                 compress_workers: int = None, hero_engine: str = "tree", progress: ProgressChannel = None):
+        if map_engine not in MAP_ENGINES:
+            raise ValueError(f"未知的地图处理方式“{map_engine}”")
+        if hero_engine not in HERO_ENGINES:
+            raise ValueError(f"未知的英雄处理方式“{hero_engine}”")
+        self.hero_engine = hero_engine
+        self.map_workers = (os.cpu_count() or 1) if map_workers is None else map_workers
+        self.compress_workers = (os.cpu_count() or 1) if compress_workers is None else compress_workers
+        self.map_engine = map_engine
+        self.map_cache = BudgetLRU(map_cache_bytes)
         self.curr_prog = 0
         self.total_prog = 2
         self.curr_stage = None
         self.lock = Lock()
+        self.progress = progress
         self.work_done = False
+        self.cancel_event = _MP_CONTEXT.Event()
         self.spell_xdbs = None
-        self.creature_conn = None
-
-    def preload(self, data:RawData):
+        self.creature_table = None
+        self.map_xdbs = {}
+        self.map_tags = {}
+        self.hero_xdbs = {}
+        self.creature_refs = None
+        self.creature_records = {}
+        self.patch_index = None
+        self.peak_rss = None
+        self.worker_peak_rss = None
+        self.num_creatures = 0
+        self.stage_times = {}
+
+    def preload(self, data:RawData, changed=None):
+        # changed, the archives RawData.refresh was given, keeps what the earlier preload read from the rest
         self._data = data
-        self._preload_maps(data)
-        self._preload_heroes(data)
-        self._preload_creatures(data)
+        previous_maps = {} if changed is None else {k: v.zip_name for i in self.map_xdbs.values() for k, v in i.items()}
+        with tracer.span("preload_maps"):
+            self._preload_maps(data, changed)
+        if changed is not None:
+            # Cached maps are keyed by name, drop those now coming from another archive or from a changed one
+            current_maps = {k: v.zip_name for i in self.map_xdbs.values() for k, v in i.items()}
+            for k, v in previous_maps.items():
+                if v in changed or current_maps.get(k) != v:
+                    self.map_cache.pop(k)
+        with tracer.span("preload_heroes"):
+            self._preload_heroes(data, changed)
+        with tracer.span("preload_creatures"):
+            self._preload_creatures(data, changed)
 
         jobs = ("TTBereinAllHeroes.chk", "TTBereinAllSpellsArtefacts.chk", "TTBereinRacialAbilityBoost.chk")
 
-        self._mods_status = MapsStatusClass(*(data.get_file("TTBerein/" + j) for j in jobs))
+        markers = [data.buckets.marker(j) for j in jobs]
+        self._mods_status = MapsStatusClass(*(None if i is None else data.get_file(i.name) for i in markers))
         self._hero_status = HeroesStatusClass(self._mods_status.racial_ability_boost is not None, )
 
         for i in range(len(self._mods_status)):
             if self._mods_status[i] is not None:
-                zip_name = data.get_zipname("TTBerein/" + jobs[i])
-                logging.warning(f"发现“{os.path.basename(zip_name)}”已安装，"
-                                f"可以进行“{MapsStatusNames[i]}”方面的兼容")
+                zip_name = markers[i].zip_name
+                logging.warning("发现“%s”已安装，可以进行“%s”方面的兼容", os.path.basename(zip_name),
+                                MapsStatusNames[i])
             else:
-                logging.warning(f"没有发现{MapsStatusNames[i]}。")
+                logging.warning("没有发现%s。", MapsStatusNames[i])
 
         return self
 
-    def _preload_maps(self, data: RawData):
+    def _preload_maps(self, data: RawData, changed=None):
+        # A map-tag file or map.xdb whose winner is still the same unchanged archive keeps its earlier record
+        previous_tags = {} if changed is None else self.map_tags
+        previous_xdbs = {} if changed is None else {k: v for i in self.map_xdbs.values() for k, v in i.items()}
+        map_tags = {}
+
         def _get_map_xdbs(map_dir, map_excl_set):
             result = {}
-            files = data.walk(map_dir, map_excl_set)
-            for file_name, _ in files:
-                map_xdb_name = None
-                if os.path.basename(file_name.lower()) == "map-tag.xdb":
-                    file_content = data.get_file(file_name)
-                    if file_content is not None:
-                        try:
-                            et = ET.fromstring(file_content)
-                        except ET.ParseError:
-                            logging.warning(f"    来自“{data.get_zipname(file_name)}”的地图文件“{file_name}”格式错误无法读取！")
-                            continue
-                        map_xdb_name = os.path.dirname(file_name) + "/" + \
-                            et.find("AdvMapDesc").attrib["href"].split("#")[0]
+            files = data.buckets.map_tag_files(map_dir, map_excl_set)
+            for file_name, zip_name in files:
+                tag = previous_tags.get(file_name)
+                if tag is None or tag.zip_name != zip_name or zip_name in changed:
+                    map_xdb_name = None
+                    try:
+                        values = data.peek_values(file_name, (("AdvMapDesc", "href"), ))
+                    except ET.ParseError:
+                        logging.warning("    来自“%s”的地图文件“%s”格式错误无法读取！", zip_name, file_name)
+                        continue
+                    if values is not None and values[0] is not None:
+                        map_xdb_name = os.path.dirname(file_name) + "/" + values[0].split("#")[0]
+                    tag = MapTagRecord(zip_name, map_xdb_name)
+                map_tags[file_name] = tag
+                map_xdb_name = tag.map_xdb_name
                 if map_xdb_name is None:
                     continue
-                map_xdb_data = data.get_file(map_xdb_name)
-                if map_xdb_data is None:
-                    logging.warning(f"    无法读取“{map_xdb_name}”，根据来自“{data.get_zipname(file_name)}”的地图文件"
-                                    f"“{file_name}”！")
+                record = previous_xdbs.get(map_xdb_name)
+                map_xdb_zip = data.get_zipname(map_xdb_name)
+                if record is not None and record.zip_name == map_xdb_zip and map_xdb_zip not in changed:
+                    result[map_xdb_name] = record
+                    continue
+                map_xdb_info = data.get_info(map_xdb_name)
+                if map_xdb_info is None:
+                    logging.warning("    无法读取“%s”，根据来自“%s”的地图文件“%s”！", map_xdb_name, zip_name, file_name)
                 else:
-                    result[map_xdb_name] = map_xdb_data
+                    result[map_xdb_name] = MapXdbInfo(map_xdb_zip, map_xdb_info.file_size)
 
             return result
 
-        with self.lock:
-            self.curr_stage = "正在预加载地图相关XDB文件入内存……"
+        self._advance(stage="正在预加载地图相关XDB文件信息……")
 
         prev_timeit = time()
         self.map_xdbs = {}
@@ -293,94 +1018,101 @@ class GameInfo:
                 self.map_xdbs[map_cat] = {}
             temp_dict = _get_map_xdbs(map_dir, map_excl_set)
             self.map_xdbs[map_cat] = {**self.map_xdbs[map_cat], **temp_dict}
+        self.map_tags = map_tags
 
-        with self.lock:
-            self.curr_prog += 1
+        self._advance(1)
 
-        logging.warning(f"地图数据预加载完毕，发现{len(self.map_xdbs)}个相关文件，用时{time() - prev_timeit:.2f}秒。")
+        self.stage_times["preload_maps"] = time() - prev_timeit
+        logging.warning("地图数据预加载完毕，发现%d个相关文件，用时%.2f秒。", sum(len(i) for i in self.map_xdbs.values()),
+                        self.stage_times['preload_maps'])
 
-    def _preload_heroes(self, data: RawData):
-        def _get_hero_xdbs(hero_dir):
+    def _preload_heroes(self, data: RawData, changed=None):
+        def _get_hero_xdbs():
             result = {}
-            files = data.walk(hero_dir)
-            for file_name, _ in files:
-                if os.path.basename(file_name.lower()).endswith(".xdb"):
-                    xdb_content = data.get_file(file_name)
-                    if xdb_content is None:
-                        continue
-                    if b"<AdvMapHeroShared" in xdb_content:
-                        et = ET.fromstring(xdb_content)
-                        if et.tag == "AdvMapHeroShared":
-                            result[file_name] = et
+            previous = {} if changed is None else self.hero_xdbs
+            for file_name, zip_name in data.buckets.hero_files():
+                record = previous.get(file_name)
+                if record is not None and record.zip_name == zip_name and zip_name not in changed:
+                    result[file_name] = record
+                    continue
+                # Only known heroes and entries not seen before get decompressed in full
+                if data.get_root_tag(file_name) != "AdvMapHeroShared":
+                    continue
+                xdb_content = data.get_file(file_name)
+                if xdb_content is None:
+                    continue
+                prev_parse = perf_counter()
+                try:
+                    et = ET.fromstring(xdb_content)
+                except ET.ParseError:
+                    logging.warning("    来自“%s”的英雄文件“%s”格式错误无法读取！", zip_name, file_name)
+                    continue
+                finally:
+                    tracer.count("xml_parse_seconds", perf_counter() - prev_parse, zip_name)
+                if et.tag == "AdvMapHeroShared":
+                    result[file_name] = HeroRecord(file_name, zip_name, et)
+            data.save_tag_index()
             return result
 
-        with self.lock:
-            self.curr_prog += 1
-            self.curr_stage = "正在预加载英雄相关XDB文件入内存……"
+        self._advance(1, "正在预加载英雄相关XDB文件入内存……")
 
         prev_timeit = time()
-        self.hero_xdbs = _get_hero_xdbs("MapObjects/")
-        logging.warning(f"英雄数据预加载完毕，发现{len(self.hero_xdbs)}个相关文件，用时{time() - prev_timeit:.2f}秒。")
+        self.hero_xdbs = _get_hero_xdbs()
+        self.stage_times["preload_heroes"] = time() - prev_timeit
+        logging.warning("英雄数据预加载完毕，发现%d个相关文件，用时%.2f秒。", len(self.hero_xdbs),
+                        self.stage_times['preload_heroes'])
 
-    def _preload_creatures(self, data: RawData):
-        with self.lock:
-            self.curr_prog += 1
-            self.curr_stage = "正在预加载生物相关XDB文件入内存……"
+    def _preload_creatures(self, data: RawData, changed=None):
+        def _unchanged(zip_name, target):
+            return changed is not None and zip_name not in changed and data.get_zipname(target) == zip_name
+
+        self._advance(1, "正在预加载生物相关XDB文件入内存……")
 
         prev_timeit = time()
-        conn = sqlite3.connect(':memory:', check_same_thread=False)
-        cur =  conn.cursor()
-        cur.execute('''CREATE TABLE CREATURE_INFOS (
-                        id TEXT PRIMARY KEY,
-                        cost INTEGER, tier INTEGER, town TEXT, town_value INTEGER, text TEXT
-                    )''')
-        cur.execute('''CREATE TABLE CREATURE_UPGRADES (
-                        ungraded TEXT, upgrade1 TEXT, upgrade2 TEXT,
-                        FOREIGN KEY(ungraded) REFERENCES CREATURE_INFO(id),
-                        FOREIGN KEY(upgrade1) REFERENCES CREATURE_INFO(id),
-                        FOREIGN KEY(upgrade2) REFERENCES CREATURE_INFO(id)
-                    )''')
-
-        creature_infos = []
-        creature_upgrades = []
-        upgrade_data = []
-        creature_xml = ET.fromstring(data.get_file("GameMechanics/RefTables/Creatures.xdb"))
-        creature_xml = creature_xml.find("objects")
-        for item_et in creature_xml:
-            creature_id = item_et.find("ID").text
-            creature_obj = item_et.find("Obj").attrib["href"].split("#")[0][1:]
-            creature_et = ET.fromstring(data.get_file(creature_obj))
-            cost = int(creature_et.find("Cost").find("Gold").text)
-            town = creature_et.find("CreatureTown").text
-            if town == "TOWN_NO_TYPE":
-                town = "TOWN_NEUTRAL"
-            tier = int(creature_et.find("CreatureTier").text)
-            upgrades = tuple(i.text for i in creature_et.find("Upgrades"))
-            visual_obj = creature_et.find("Visual").attrib["href"].split("#")[0][1:]
-            visual_et = ET.fromstring(data.get_file(visual_obj))
-            name_text = visual_et.find("CreatureNameFileRef").attrib["href"]
-            if name_text != "":
-                creature_infos.append((creature_id, cost, tier, town, TOWN_VALUE[town], name_text))
-                if len(upgrades) > 0:
-                    creature_upgrades.append((creature_id, *upgrades))
-
-        for id_, up1, up2 in creature_upgrades:
-            upgrade_data.append({"id" : id_, "upgrade" : 0})
-            upgrade_data.append({"id" : up1, "upgrade" : 1})
-            upgrade_data.append({"id" : up2, "upgrade" : 2})
-
-        cur.executemany("INSERT INTO CREATURE_INFOS VALUES (?, ?, ?, ?, ?, ?)", creature_infos)
-        cur.execute("ALTER TABLE CREATURE_INFOS ADD COLUMN upgrade INTEGER DEFAULT 0")
-        cur.executemany("UPDATE CREATURE_INFOS SET upgrade = :upgrade WHERE id = :id", upgrade_data)
-        cur.executemany("insert into CREATURE_UPGRADES values (?, ?, ?)", creature_upgrades)
-        conn.commit()
-        self.creature_conn = conn
-        logging.warning(f"生物数据预加载完毕，发现{len(creature_infos)}个相关文件，用时{time() - prev_timeit:.2f}秒。")
-
-    def work(self, map_options: dict[str, MapsStatusClass[bool]], hero_options: HeroesStatusClass):
+        table = CreatureTable()
+        ref_table = data.buckets.ref_table("Creatures.xdb")
+        if self.creature_refs is None or not _unchanged(self.creature_refs[0], ref_table.name):
+            creature_xml = ET.fromstring(data.get_file(ref_table.name)).find("objects")
+            refs = [(i.find("ID").text, i.find("Obj").attrib["href"].split("#")[0][1:]) for i in creature_xml]
+            self.creature_refs = (ref_table.zip_name, refs)
+        previous = self.creature_records if changed is not None else {}
+        self.creature_records = {}
+        for creature_id, creature_obj in self.creature_refs[1]:
+            # Both the creature and its visual have to come from the same unchanged archives to skip the reads
+            record = previous.get(creature_id)
+            if record is None or record.obj != creature_obj or not _unchanged(record.obj_zip, creature_obj) \
+                    or not _unchanged(record.visual_zip, record.visual):
+                cost, town, tier, upgrades, visual_href = data.peek_values(
+                    creature_obj, (("Cost/Gold", None), ("CreatureTown", None), ("CreatureTier", None),
+                                   ("Upgrades/*", None), ("Visual", "href")))
+                cost = int(cost)
+                if town == "TOWN_NO_TYPE":
+                    town = "TOWN_NEUTRAL"
+                tier = int(tier)
+                upgrades = tuple(upgrades)
+                visual_obj = visual_href.split("#")[0][1:]
+                name_text, = data.peek_values(visual_obj, (("CreatureNameFileRef", "href"), ))
+                info = CreatureInfo(town, cost, name_text, tier, upgrades) if name_text != "" else None
+                record = CreatureRecord(creature_obj, data.get_zipname(creature_obj), visual_obj,
+                                        data.get_zipname(visual_obj), info)
+            self.creature_records[creature_id] = record
+            if record.info is not None:
+                table.add(creature_id, record.info)
+
+        self.creature_table = table.build(TOWN_VALUE)
+        self.num_creatures = len(table)
+        self.stage_times["preload_creatures"] = time() - prev_timeit
+        logging.warning("生物数据预加载完毕，发现%d个相关文件，用时%.2f秒。", len(table),
+                        self.stage_times['preload_creatures'])
+
+    def work(self, map_options: dict[str, MapsStatusClass[bool]], hero_options: HeroesStatusClass,
+             incremental: bool = True):
         with self.lock:
             self.curr_prog = 1
             self.work_done = False
+        self.cancel_event.clear()
+        _set_cancel_event(self.cancel_event)
+        self.worker_peak_rss = None
 
         if all(j is False for i in map_options.values() for j in i):
             raise ValueError("无任何选项被勾选，退回！")
@@ -391,157 +1123,206 @@ class GameInfo:
                 os.makedirs(mod_dir)
             except FileExistsError:
                 err_msg = f"{mod_dir}是个文件，不是文件夹，请删除该文件后再运行。"
-                logging.warning("出错，任务中断！" + err_msg)
+                logging.warning("出错，任务中断！%s", err_msg)
                 raise ValueError(err_msg)
             except OSError:
                 err_msg = f"无法创建{mod_dir}，请检查游戏文件夹是否是只读。"
-                logging.warning("出错，任务中断！"+ err_msg)
+                logging.warning("出错，任务中断！%s", err_msg)
                 raise ValueError(err_msg)
         map_options["nochange"] = deepcopy(map_options["customized"])
         num_map_xmls = sum(len(v) for k, v in self.map_xdbs.items() if any(i for i in map_options[k]))
         num_hero_xmls = 0 if all(i.racial_ability_boost is False for i in map_options.values()) else len(self.hero_xdbs)
         with self.lock:
-            self.total_prog = num_map_xmls +  1 if num_hero_xmls else 0
+            self.total_prog = num_map_xmls + (1 if num_hero_xmls else 0)
+        self._advance()
 
-        try:
-            merged_patch, _ = remove_merged_patch()
-        except PermissionError as e:
-            raise ValueError(str(e))
+        # The patch is built next to the previous one, which stays untouched until the new one replaces it.
+        # A failed or cancelled build only leaves the temporary file behind, and that is removed.
+        merged_patch = os.path.join(mod_dir, PATCH_FILE_NAME)
+        build_patch = merged_patch + ".tmp"
+        self.patch_index = PatchIndex(per.VERSION, merged_patch if incremental else None)
 
         try:
-            with ZipFile(merged_patch, "w", compression=ZIP_DEFLATED,
-                        compresslevel=9) as zfp:
+            with ZipFile(build_patch, "w", compression=ZIP_DEFLATED, compresslevel=9) as zf, \
+                    PatchWriter(zf, self.compress_workers, cancel=self.cancel_event,
+                                date_time=patch_date_time(self._data.newest_date_time)) as zfp:
                 logging.warning("开始生成兼容文件")
                 if num_map_xmls > 0:
-                    logging.warning(f"  共有{num_map_xmls}个地图xdb文件需要处理")
-                    self._work_maps(map_options, zfp)
+                    logging.warning("  共有%d个地图xdb文件需要处理", num_map_xmls)
+                    with tracer.span("work_maps"):
+                        self._work_maps(map_options, zfp)
                 if num_hero_xmls > 0:
-                    logging.warning(f"  共有{num_hero_xmls}个英雄xdb文件需要处理")
-                    self._work_heroes(hero_options, zfp)
-                self._work_creatures(zfp)
-                logging.warning(f"兼容补丁文件{merged_patch}已经生成")
+                    logging.warning("  共有%d个英雄xdb文件需要处理", num_hero_xmls)
+                    with tracer.span("work_heroes"):
+                        self._work_heroes(hero_options, zfp)
+                with tracer.span("work_creatures"):
+                    self._work_creatures(zfp)
+                self.patch_index.write(zfp)
+            self.patch_index.close()
+            os.replace(build_patch, merged_patch)
+            if self.patch_index.reused > 0:
+                logging.warning("  沿用旧补丁中未改变的%d个文件", self.patch_index.reused)
+            logging.warning("兼容补丁文件%s已经生成", merged_patch)
+            # A peak since the process started, in watch mode it covers the earlier builds too; the map workers
+            # are new processes each build
+            self.peak_rss = get_peak_rss()
+            if self.peak_rss is not None:
+                logging.warning("  主进程启动以来内存峰值%.1fMB", self.peak_rss / 1048576)
+            if self.worker_peak_rss is not None:
+                logging.warning("  地图子进程内存峰值%.1fMB", self.worker_peak_rss / 1048576)
 
         except PermissionError:
-            err_msg = f"无法创建{merged_patch}。请检查你是否对该文件夹有写权限。"
-            logging.warning("出错，任务中断！"+ err_msg)
-            raise ValueError()
+            err_msg = f"无法创建{merged_patch}。请检查你是否对该文件夹有写权限，\n" \
+                      f"以及游戏或者地图编辑器是否正在运行，如果是的话请关闭游戏或者地图编辑器。"
+            logging.warning("出错，任务中断！%s", err_msg)
+            raise ValueError(err_msg)
+        except InterruptedError:
+            logging.warning("用户中断了操作！")
+            raise
+        finally:
+            self.patch_index.close()
+            # Open archives can't be replaced on Windows, nothing stays open while the game or a watch waits
+            self._data.zip_pool.close()
+            if os.path.isfile(build_patch):
+                os.remove(build_patch)
 
         with self.lock:
             self.work_done = True
 
         return self
 
-    def _work_maps(self, map_options: dict[str, MapsStatusClass[bool]], zfp: ZipFile):
+    def _work_maps(self, map_options: dict[str, MapsStatusClass[bool]], zfp: PatchWriter):
         prev_timeit = time()
 
-        def __empty_element_by_tag(et: ET.Element, tag_to_empty):
-            to_remove_et = et.find(tag_to_empty)
-            to_remove_et_i = list(et).index(to_remove_et)
-            et.remove(to_remove_et)
-            et.insert(to_remove_et_i, ET.Element(tag_to_empty))
-
-        def __union_items_btw_et_and_set(et1: ET.Element, set2: set[str]):
-            # et1 will be modified
-            set1 = set(i.text for i in et1)
-            if len(set1) > 0:
-                for i in set2:
-                    if i not in set1:
-                        ele = ET.Element("Item")
-                        ele.text = i
-                        et1.append(ele)
-
-        def _add_missing_towns_and_arti(map_et: ET.Element):
-            towns = set()
-            artis = set()
-
-            objects_et = map_et.find("objects")
-            for i in objects_et.findall("Item"):
-                adv_town_et = i.find("AdvMapTown")
-                if adv_town_et is not None:
-                    towns.add(adv_town_et.find("Name").text)
-                else:
-                    adv_arti_et = i.find("AdvMapArtifact")
-                    if adv_arti_et is not None:
-                        adv_arti_name = adv_arti_et.find("Name").text
-                        if adv_arti_name is not None and adv_arti_name != "":
-                            artis.add(adv_arti_name)
-
-            for rab in per.rab_xdbs:
-                if rab not in towns:
-                    objects_et.append(per.rab_xdbs[rab])
-
-            for arti in per.artificer_artefact_names:
-                if arti not in artis:
-                    objects_et.append(per.get_artificer_artefact_xdb(arti))
-
-        def _enable_all_spells_artefacts(map_et: ET.Element, cat: str):
-            def _sub_process(tag, all_set):
-                if not (cat == "scenario" and tag == "artifactIDs"):
-                    if cat == "nochange":
-                        pass
-                    elif cat in ("scenario", "singlemissions"):
-                        __union_items_btw_et_and_set(map_et.find(tag), all_set)
-                    else:
-                        __empty_element_by_tag(map_et, tag)
-
-            params = (("spellIDs", per.all_spells_set), ("artifactIDs", per.all_artefacts_set))
-            for param1, param2 in params:
-                _sub_process(param1, param2)
-
-        def _enable_all_heroes(map_et: ET.Element):
-            __empty_element_by_tag(map_et, "AvailableHeroes")
-
-        def _enable_map_script(map_et: ET.Element):
-            script_et = map_et.find("MapScript")
-            if script_et is not None and ("href" not in script_et.attrib or script_et.attrib["href"] == ""):
-                script_et.attrib["href"] = MAPSCRIPT_HREF
-                return True
-            else:
-                return False
-
+        jobs = []
         for cat in self.map_xdbs:
             if any(i for i in map_options[cat]):
                 for xml_name in self.map_xdbs[cat]:
-                    sub_prev_timeit = time()
-                    with self.lock:
-                        self.curr_stage = f"正在处理地图文件{xml_name}"
-                        self.curr_prog += 1
-
-                    if type(self.map_xdbs[cat][xml_name]) is not ET.Element:
-                        try:
-                            self.map_xdbs[cat][xml_name] = ET.fromstring(self.map_xdbs[cat][xml_name])
-                        except ET.ParseError:
-                            logging.warning(f"    来自“{self._data.get_zipname(xml_name)}”的地图文件"
-                                            f"“{xml_name}”格式错误无法读取！")
-                            continue
-
-                    if map_options[cat].all_heroes is True and cat != "nochange":
-                        _enable_all_heroes(self.map_xdbs[cat][xml_name])
-                    if map_options[cat].all_spells_artefacts is True:
-                        _enable_all_spells_artefacts(self.map_xdbs[cat][xml_name], cat)
-                    if map_options[cat].racial_ability_boost is True:
-                        _add_missing_towns_and_arti(self.map_xdbs[cat][xml_name])
-                        if _enable_map_script(self.map_xdbs[cat][xml_name]) is True:
-                            xml_dir = os.path.dirname(xml_name)
-                            zfp.writestr(os.path.join(xml_dir, MAPSCRIPT_XDB), per.get_xml(MAPSCRIPT_XDB))
-                            zfp.writestr(os.path.join(xml_dir, MAPSCRIPT_LUA), per.get_xml(MAPSCRIPT_LUA))
-
-                    ET.indent(self.map_xdbs[cat][xml_name], space="    ", level=0)
-                    zfp.writestr(xml_name, ET.tostring(self.map_xdbs[cat][xml_name], short_empty_elements=True,
-                                                        encoding='utf8', method='xml'))
-
-                    with self.lock:
-                        if self.work_done is True:
-                            logging.warning("用户中断了操作！")
-                            raise InterruptedError
-                    logging.info(f"    地图文件{xml_name}处理完毕，耗时{time() - sub_prev_timeit:.2f}秒；")
-
-        logging.warning(f"  地图xdb文件处理完毕，共耗时{time() - prev_timeit:.2f}秒。")
+                    index_inputs = (self.map_engine, cat, tuple(map_options[cat]), self._data.get_fingerprint(xml_name))
+                    if self.patch_index.reuse(xml_name, index_inputs, zfp) is not None:
+                        self._advance(1)
+                        logging.info("    地图文件%s未改变，沿用旧补丁；", xml_name)
+                        continue
+                    jobs.append((cat, xml_name, index_inputs))
+        # Largest maps first so big campaign maps don't end up as the tail of a parallel run
+        jobs.sort(key=lambda x: self.map_xdbs[x[0]][x[1]].size, reverse=True)
+
+        num_workers = min(self.map_workers, len(jobs))
+        if num_workers > 1:
+            results = self._work_maps_parallel(map_options, jobs, num_workers)
+        else:
+            results = self._work_maps_serial(map_options, jobs)
+
+        try:
+            self._write_maps(jobs, results, zfp)
+        finally:
+            # Ends the pool of a parallel run right away on a cancel or an error, not when the generator is collected
+            results.close()
+
+        self.stage_times["work_maps"] = time() - prev_timeit
+        logging.warning("  地图xdb文件处理完毕，共耗时%.2f秒，地图缓存命中%d次，未命中%d次。",
+                        self.stage_times['work_maps'], self.map_cache.hits, self.map_cache.misses)
 
         return self
 
-    def _work_heroes(self, hero_options: HeroesStatusClass, zfp: ZipFile):
+    def _write_maps(self, jobs: list, results, zfp: PatchWriter):
+        for (cat, xml_name, index_inputs), result in zip(jobs, results):
+            if result is None:
+                continue
+            _, xml_data, add_script, timings = result
+            elapsed = timings.parse + timings.transform + timings.serialize
+            zip_name = self._data.get_zipname(xml_name)
+            tracer.add_span("map", "map", timings.start, elapsed, pid=timings.pid,
+                            tid=0 if timings.pid != os.getpid() else None, args={"file": xml_name, "archive": zip_name})
+            tracer.count("xml_parse_seconds", timings.parse, zip_name)
+            tracer.count("xml_serialize_seconds", timings.serialize, zip_name)
+            if timings.pid != os.getpid() and timings.peak_rss is not None:
+                self.worker_peak_rss = max(self.worker_peak_rss or 0, timings.peak_rss)
+            if xml_data is None:
+                logging.warning("    来自“%s”的地图文件“%s”格式错误无法读取！", self._data.get_zipname(xml_name),
+                                xml_name)
+                continue
+
+            outputs = [xml_name]
+            if add_script is True:
+                xml_dir = os.path.dirname(xml_name)
+                zfp.writestr(os.path.join(xml_dir, MAPSCRIPT_XDB), per.get_xml(MAPSCRIPT_XDB))
+                zfp.writestr(os.path.join(xml_dir, MAPSCRIPT_LUA), per.get_xml(MAPSCRIPT_LUA))
+                outputs.extend((os.path.join(xml_dir, MAPSCRIPT_XDB), os.path.join(xml_dir, MAPSCRIPT_LUA)))
+
+            zfp.writestr(xml_name, xml_data, zip_name)
+            self.patch_index.record(xml_name, index_inputs, outputs)
+            # Nothing keeps the serialized map or its tree once it is in the patch
+            del result, xml_data
+
+            self._check_cancelled()
+            logging.info("    地图文件%s处理完毕，耗时%.2f秒；", xml_name, elapsed)
+
+    def _load_map(self, xml_name: str):
+        map_data = self.map_cache.get(xml_name, self._data.get_file)
+        if map_data is None:
+            logging.warning("    无法读取来自“%s”的地图文件“%s”！", self._data.get_zipname(xml_name), xml_name)
+        return map_data
+
+    def _work_maps_serial(self, map_options: dict[str, MapsStatusClass[bool]], jobs: list):
+        engine = MAP_ENGINES[self.map_engine]
+        for cat, xml_name, _ in jobs:
+            self._advance(1, f"正在处理地图文件{xml_name}")
+
+            if self.map_engine == "stream" and xml_name not in self.map_cache:
+                # The streaming engine reads straight from the archive and never holds the whole map
+                try:
+                    with self._data.open_file(xml_name) as src:
+                        yield engine(xml_name, cat, map_options[cat], src)
+                    continue
+                except InterruptedError:
+                    # A cancel, not a read failure: it is an OSError too
+                    raise
+                except (BadZipFile, KeyError, OSError, zlib.error):
+                    pass
+
+            map_data = self._load_map(xml_name)
+            yield None if map_data is None else engine(xml_name, cat, map_options[cat], map_data)
+
+    def _work_maps_parallel(self, map_options: dict[str, MapsStatusClass[bool]], jobs: list, num_workers: int):
+        # Workers parse, transform and serialize, this thread stays the only writer of the ZipFile.
+        # Only a window of maps is decompressed and handed to the workers at a time,
+        # results are yielded in job order so the patch layout does not depend on scheduling.
+        self._advance(stage=f"正在用{num_workers}个进程处理地图文件")
+
+        engine = MAP_ENGINES[self.map_engine]
+        executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=_MP_CONTEXT,
+                                       initializer=_set_cancel_event, initargs=(self.cancel_event, ))
+        try:
+            pending = deque()
+            remaining = iter(jobs)
+
+            def _submit_next():
+                for cat, xml_name, _ in remaining:
+                    map_data = self._load_map(xml_name)
+                    pending.append(None if map_data is None else
+                                   executor.submit(engine, xml_name, cat, map_options[cat], map_data))
+                    return
+
+            for _ in range(num_workers * 2):
+                _submit_next()
+
+            for _, xml_name, _ in jobs:
+                future = pending.popleft()
+                _submit_next()
+                while future is not None and not future.done():
+                    wait((future, ), timeout=0.05)
+                    self._check_cancelled()
+                self._advance(1, f"正在处理地图文件{xml_name}")
+                yield None if future is None else future.result()
+        finally:
+            # Workers see a cancel through the shared event, so waiting for them takes one chunk of work at most
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _work_heroes(self, hero_options: HeroesStatusClass, zfp: PatchWriter):
         def _load_spell_xdb(hero_class):
+            if hero_class is None:
+                return set()
             xml_name = "spells_{}.xml".format(hero_class[len("HERO_CLASS_"):])
             try:
                 spell_et = ET.fromstring(per.get_xml(xml_name))
@@ -549,178 +1330,127 @@ class GameInfo:
                 return set()
             return {i.text for i in spell_et.findall("Item")}
 
-        def __union_items_btw_et_and_set(et1: ET.Element, set2: set[str]):
-            result = 0
-            # et1 will be modified
-            set1 = set(i.text for i in et1)
-            for i in set2:
-                if i not in set1:
-                    ele = ET.Element("Item")
-                    ele.text = i
-                    et1.append(ele)
-                    result += 1
-            return result
-
-        def _swap_skills(hero_et: ET.Element):
-            result = 0
-
-            skills = set()
-            for i in hero_et.find("PrimarySkill"):
-                if i.tag == "SkillID":
-                    skills.add(i.text)
-            for i in hero_et.find("Editable").find("skills"):
-                skills.add(i.find("SkillID").text)
-
-            perks_et = hero_et.find("Editable").find("perkIDs")
-            for i in perks_et:
-                if i.text in per.perk_swaps:
-                    if per.perk_swaps[i.text][1] in skills:
-                        i.text = per.perk_swaps[i.text][0]
-                        result += 1
-
-            return result
-
-        def _swap_specialization(hero_et: ET.Element):
-            result = 0
-
-            hero_specialization = hero_et.find("Specialization").text
-            if hero_specialization in per.specialization_swaps:
-                hero_et.find("Specialization").text = per.specialization_swaps[hero_specialization][0]
-                hero_et.find("SpecializationNameFileRef").attrib["href"] = \
-                    per.specialization_swaps[hero_specialization][1]
-                hero_et.find("SpecializationDescFileRef").attrib["href"] = \
-                    per.specialization_swaps[hero_specialization][2]
-                hero_et.find("SpecializationIcon").attrib["href"] = \
-                    per.specialization_swaps[hero_specialization][3]
-                result += 1
-
-            return result
-
-        def _get_hero_name_and_specialization(hero_et: ET.Element):
-            return hero_et.find("InternalName").text, hero_et.find("Specialization").text
+        def _missing_spells(hero: HeroRecord, spells: set[str]):
+            existing = set(hero.spells)
+            return [i for i in sorted(spells) if i not in existing]
+
+        def _swap_perks(hero: HeroRecord):
+            # {position in perkIDs: new perk}
+            return {n: per.perk_swaps[i][0] for n, i in enumerate(hero.perks)
+                    if i in per.perk_swaps and per.perk_swaps[i][1] in hero.skills}
+
+        def _materialize(hero: HeroRecord, new_spells: list, new_perks: dict, new_specialization):
+            # The hero's tree with the changes worked out on its record applied, and the bytes it was parsed from
+            hero_data = self._data.get_file(hero.file_name)
+            if hero_data is None:
+                return None, None
+            hero_et = ET.fromstring(hero_data)
+            spells_et = hero_et.find("Editable").find("spellIDs")
+            for i in new_spells:
+                ele = ET.Element("Item")
+                ele.text = i
+                spells_et.append(ele)
+            perks_et = list(hero_et.find("Editable").find("perkIDs"))
+            for n, perk in new_perks.items():
+                perks_et[n].text = perk
+            if new_specialization is not None:
+                hero_et.find("Specialization").text = new_specialization[0]
+                hero_et.find("SpecializationNameFileRef").attrib["href"] = new_specialization[1]
+                hero_et.find("SpecializationDescFileRef").attrib["href"] = new_specialization[2]
+                hero_et.find("SpecializationIcon").attrib["href"] = new_specialization[3]
+            return hero_data, hero_et
 
         if self.spell_xdbs is None:
             self.spell_xdbs = {}
 
-        with self.lock:
-            self.curr_stage = f"正在处理英雄文件数据文件"
+        self._advance(stage="正在处理英雄文件数据文件")
 
         prev_timeit = time()
         hero_spec_info = {i: set() for i in SPECIALIZATION_INFO.keys()}
-        for hero_xml, hero_et in self.hero_xdbs.items():
-            changes = 0
-            if hero_options.racial_ability_boost is True:
-                hero_class = hero_et.find("Class").text
-                if hero_class not in self.spell_xdbs:
-                    self.spell_xdbs[hero_class] = _load_spell_xdb(hero_class)
-                changes += __union_items_btw_et_and_set(hero_et.find("Editable").find("spellIDs"),
-                                                        self.spell_xdbs[hero_class])
+        for hero_xml, hero in self.hero_xdbs.items():
+            index_inputs = (self.hero_engine, tuple(hero_options), self._data.get_fingerprint(hero_xml))
+            record = self.patch_index.reuse(hero_xml, index_inputs, zfp)
+            if record is not None:
+                if record["extra"] is not None:
+                    hero_name, hero_spec = record["extra"]
+                    if hero_spec in hero_spec_info:
+                        hero_spec_info[hero_spec].add(hero_name)
+                logging.info("    英雄文件%s未改变，沿用旧补丁；", hero_xml)
+                continue
 
-                changes += _swap_skills(hero_et)
-                changes += _swap_specialization(hero_et)
+            new_spells = []
+            new_perks = {}
+            new_specialization = None
+            spec_extra = None
+            if hero_options.racial_ability_boost is True:
+                if hero.hero_class not in self.spell_xdbs:
+                    self.spell_xdbs[hero.hero_class] = _load_spell_xdb(hero.hero_class)
+                new_spells = _missing_spells(hero, self.spell_xdbs[hero.hero_class])
+                new_perks = _swap_perks(hero)
+                new_specialization = per.specialization_swaps.get(hero.specialization)
 
                 # After specialization swap, process special handling needed in script
-                hero_name, hero_spec = _get_hero_name_and_specialization(hero_et)
+                hero_name = hero.internal_name
+                hero_spec = hero.specialization if new_specialization is None else new_specialization[0]
+                spec_extra = (hero_name, hero_spec)
                 for k in SPECIALIZATION_INFO.keys():
                     if hero_spec == k:
                         hero_spec_info[k].add(hero_name)
 
+            changes = len(new_spells) + len(new_perks) + (new_specialization is not None)
             if changes > 0:
-                ET.indent(hero_et, space="    ", level = 0)
-                zfp.writestr(hero_xml, ET.tostring(hero_et, short_empty_elements=True, encoding='utf8', method='xml'))
-                logging.info(f"    英雄文件{hero_xml}处理完毕；")
+                zip_name = hero.zip_name
+                with tracer.span("hero", "hero", file=hero_xml, archive=zip_name):
+                    hero_data, hero_et = _materialize(hero, new_spells, new_perks, new_specialization)
+                    if hero_et is None:
+                        logging.warning("    无法读取来自“%s”的英雄文件“%s”！", zip_name, hero_xml)
+                        continue
+                    prev_serialize = perf_counter()
+                    if self.hero_engine == "edit":
+                        hero_data = _edit_hero(hero_data, hero_et)
+                    else:
+                        ET.indent(hero_et, space="    ", level = 0)
+                        hero_data = ET.tostring(hero_et, short_empty_elements=True, encoding='utf8', method='xml')
+                    tracer.count("xml_serialize_seconds", perf_counter() - prev_serialize, zip_name)
+                    zfp.writestr(hero_xml, hero_data, zip_name)
+                self.patch_index.record(hero_xml, index_inputs, [hero_xml], spec_extra)
+                logging.info("    英雄文件%s处理完毕；", hero_xml)
             else:
-                logging.info(f"    英雄文件{hero_xml}无需处理，略过……")
+                self.patch_index.record(hero_xml, index_inputs, [], spec_extra)
+                logging.info("    英雄文件%s无需处理，略过……", hero_xml)
 
-            with self.lock:
-                if self.work_done is True:
-                    logging.warning("用户中断了操作！")
-                    raise InterruptedError
+            self._check_cancelled()
 
-        with self.lock:
-            self.curr_stage = f"正在处理特殊特长脚本文件"
+        self._advance(stage="正在处理特殊特长脚本文件")
 
         for k, v in hero_spec_info.items():
             if len(v) > 0:
                 lua_content = "{0} = {{{1}}}".format(SPECIALIZATION_INFO[k].var,
                                                      ", ".join(sorted(["\"{}\"".format(i) for i in v])))
                 zfp.writestr(SPECIALIZATION_INFO[k].script, lua_content)
-                logging.info(f"    特殊英雄信息已经写入{SPECIALIZATION_INFO[k].script}；")
+                logging.info("    特殊英雄信息已经写入%s；", SPECIALIZATION_INFO[k].script)
 
-            with self.lock:
-                if self.work_done is True:
-                    logging.warning("用户中断了操作！")
-                    raise InterruptedError
+            self._check_cancelled()
 
-        logging.warning(f"  英雄xdb文件处理完毕，共耗时{time() - prev_timeit:.2f}秒。")
+        self.stage_times["work_heroes"] = time() - prev_timeit
+        logging.warning("  英雄xdb文件处理完毕，共耗时%.2f秒。", self.stage_times['work_heroes'])
 
         return self
 
-    def _work_creatures(self, zfp: ZipFile):
-        def _generate_lua_body(cur: sqlite3.Cursor, var_name:str, sql_query: str):
-            result = []
-            if "CREATURE_UNGRADE2UPGRADED[1]" in var_name:
-                result.append("CREATURE_UNGRADE2UPGRADED = {[1] = {}, [2] = {}}")
-                result.append("")
-
-            result.append("{} = {{".format(var_name))
-
-            cur.execute(sql_query)
-            format_string = "    [{}] = "
-            queried = cur.fetchall()
-            if type(queried[0][1]).__name__ == "int":
-                format_string += "{},"
-            else:
-                if queried[0][1].startswith("CREATURE_") or queried[0][1].startswith("TOWN_"):
-                    format_string += "{},"
-                else:
-                    format_string += "\"{}\","
-
-            result.extend([format_string.format(i, j) for i, j in queried])
-            result.append("}")
-            result.append("")
-
-            return result
-
-        lua_to_do = {
-            "CREATURE2TEXT" : "SELECT id, text FROM CREATURE_INFOS ORDER BY town_value, tier, upgrade, id",
-            "CREATURE2COST" : "SELECT id, cost FROM CREATURE_INFOS ORDER BY town_value, tier, upgrade, id",
-            "CREATURE2TIER" : "SELECT id, tier FROM CREATURE_INFOS ORDER BY town_value, tier, upgrade, id",
-            "CREATURE2TOWN" : "SELECT id, town FROM CREATURE_INFOS ORDER BY town_value, tier, upgrade, id",
-            "CREATURE2GRADE" : "SELECT id, upgrade FROM CREATURE_INFOS ORDER BY town_value, tier, upgrade, id",
-            "CREATURE_UPGRADE2UNGRADED" : \
-                """
-                SELECT upgraded, ungraded FROM
-                    (SELECT cu1.upgrade1 AS upgraded, cu1.ungraded AS ungraded, ci.town_value, ci.tier, ci.upgrade
-                     FROM CREATURE_UPGRADES cu1 JOIN CREATURE_INFOS ci ON ci.id = cu1.upgrade1
-                     UNION
-                     SELECT cu2.upgrade2 AS upgraded, cu2.ungraded AS ungraded, ci.town_value, ci.tier, ci.upgrade
-                     FROM CREATURE_UPGRADES cu2 JOIN CREATURE_INFOS ci ON ci.id = cu2.upgrade2)
-                ORDER BY town_value, tier, upgrade
-                """,
-            "CREATURE_UNGRADE2UPGRADED[1]" : \
-                """
-                SELECT ci.id, cu.upgrade1
-                FROM CREATURE_INFOS ci JOIN CREATURE_UPGRADES cu ON ci.id = cu.ungraded
-                ORDER BY ci.town_value, ci.tier, ci.upgrade""",
-            "CREATURE_UNGRADE2UPGRADED[2]" : \
-                """
-                SELECT ci.id, cu.upgrade2
-                FROM CREATURE_INFOS ci JOIN CREATURE_UPGRADES cu ON ci.id = cu.ungraded
-                ORDER BY ci.town_value, ci.tier, ci.upgrade"""
-        }
-
-        lua_content = []
-        cur = self.creature_conn.cursor()
-        for var_name, sql_query in lua_to_do.items():
-            lua_content.extend(_generate_lua_body(cur, var_name, sql_query))
-
-        zfp.writestr(CREATURE_INFO, "\n".join(lua_content))
-        logging.info(f"    生物信息已经写入{CREATURE_INFO}；")
+    def _work_creatures(self, zfp: PatchWriter):
+        prev_timeit = time()
+        zfp.writestr(CREATURE_INFO, self.creature_table.lua())
+        self.stage_times["work_creatures"] = time() - prev_timeit
+        logging.info("    生物信息已经写入%s；", CREATURE_INFO)
 
     def cancel(self):
         with self.lock:
             self.work_done = True
+        self.cancel_event.set()
+
+    def _check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise InterruptedError
 
     @property
     def mod_status(self):
@@ -734,9 +1464,18 @@ class GameInfo:
     def get_time_weightage():
         return 0.25
 
+    def _advance(self, step: int = 0, stage: str = None):
+        with self.lock:
+            self.curr_prog += step
+            if stage is not None:
+                self.curr_stage = stage
+            stage, fraction = self.curr_stage, self.curr_prog / self.total_prog if self.total_prog > 0 else 1.0
+        if self.progress is not None and stage is not None:
+            self.progress.publish("game", stage, fraction)
+
     def get_progress(self):
         with self.lock:
-            return self.curr_prog / self.total_prog
+            return self.curr_prog / self.total_prog if self.total_prog > 0 else 1.0
 
     def get_stage(self):
         with self.lock:
@@ -0,0 +1,134 @@
+import argparse
+import os
+from collections import namedtuple
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+# Sizes of a generated install: maps per official category, objects of the smallest map (the n-th map of a
+# category has n times as many), heroes, player made .h5m maps and irrelevant entries padding data.pak
+FakeInstallScale = namedtuple("FakeInstallScale", ["maps", "objects", "heroes", "custom_maps", "filler"])
+SCALES = {
+    "small": FakeInstallScale(3, 500, 20, 5, 0),
+    "medium": FakeInstallScale(8, 2000, 150, 20, 2000),
+    "large": FakeInstallScale(20, 4000, 400, 60, 10000),
+}
+MAP_CATEGORIES = ("Scenario", "SingleMissions", "Multiplayer")
+CHK_FILES = ("TTBereinAllHeroes.chk", "TTBereinAllSpellsArtefacts.chk", "TTBereinRacialAbilityBoost.chk")
+_TOWNS = ("TOWN_HEAVEN", "TOWN_INFERNO", "TOWN_NO_TYPE")
+_MAP_TAG = b'<?xml version="1.0" encoding="UTF-8"?>\n<Map><AdvMapDesc href="map.xdb#xpointer(/AdvMapDesc)"/></Map>\n'
+# Every entry gets the same stamp, writestr would take the current time
+_DATE_TIME = (2006, 5, 16, 0, 0, 0)
+
+
+def _writestr(zf: ZipFile, name: str, data):
+    zinfo = ZipInfo(name, date_time=_DATE_TIME)
+    zinfo.compress_type = zf.compression
+    zinfo.external_attr = 0o600 << 16
+    zf.writestr(zinfo, data)
+
+
+def map_xdb(num_objects: int):
+    # An AdvMapDesc with a town every 50 objects, artefacts every 7 and static objects in between
+    items = []
+    for i in range(num_objects):
+        if i % 50 == 0:
+            items.append(f'<Item href="#n:inline(AdvMapTown)" id="item_t{i}"><AdvMapTown><Name>Town{i}</Name>'
+                         f'</AdvMapTown></Item>')
+        elif i % 7 == 0:
+            items.append(f'<Item href="#n:inline(AdvMapArtifact)" id="item_a{i}"><AdvMapArtifact>'
+                         f'<Name>Wand_SPELL_PRAYER_{i % 30 + 1}</Name></AdvMapArtifact></Item>')
+        else:
+            items.append(f'<Item href="#n:inline(AdvMapStatic)" id="item_s{i}"><AdvMapStatic><Pos><x>{i}</x>'
+                         f'<y>{i}</y></Pos></AdvMapStatic></Item>')
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<AdvMapDesc>\n<objects>' + "\n".join(items) + '</objects>\n'
+            '<AvailableHeroes><Item>Hero1</Item></AvailableHeroes>\n<spellIDs><Item>SPELL_PRAYER</Item></spellIDs>\n'
+            '<artifactIDs><Item>ARTIFACT_X</Item></artifactIDs>\n<MapScript href=""/>\n</AdvMapDesc>\n').encode()
+
+
+def hero_xdb(i: int):
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<AdvMapHeroShared>
+    <InternalName>Hero{i}</InternalName>
+    <Class>HERO_CLASS_KNIGHT</Class>
+    <PrimarySkill><SkillID>HERO_SKILL_TRAINING</SkillID><Mastery>MASTERY_BASIC</Mastery></PrimarySkill>
+    <Specialization>{"HERO_SPEC_DARK_ACOLYTE" if i % 5 == 0 else "HERO_SPEC_NONE"}</Specialization>
+    <SpecializationNameFileRef href="a"/>
+    <SpecializationDescFileRef href="b"/>
+    <SpecializationIcon href="c"/>
+    <Editable>
+        <skills><Item><SkillID>HERO_SKILL_AVENGER</SkillID></Item></skills>
+        <perkIDs><Item>HERO_SKILL_PRAYER</Item><Item>HERO_SKILL_MULTISHOT</Item></perkIDs>
+        <spellIDs><Item>SPELL_PRAYER</Item></spellIDs>
+    </Editable>
+</AdvMapHeroShared>
+'''.encode()
+
+
+def _write_creatures(zf: ZipFile):
+    # Creatures.xdb plus the creature and visual files it points to, two tiers with two upgrades per town
+    objs = []
+    for town in _TOWNS:
+        for tier in (1, 2):
+            base = f"CREATURE_{town}_{tier}"
+            for up, creature_id in enumerate((base, base + "_U1", base + "_U2")):
+                objs.append(f'<Item><ID>{creature_id}</ID><Obj href="/GameMechanics/Creature/Creatures/'
+                            f'{creature_id}.xdb#xpointer(/Creature)"/></Item>')
+                ups = f"<Item>{base}_U1</Item><Item>{base}_U2</Item>" if up == 0 else ""
+                _writestr(zf, f"GameMechanics/Creature/Creatures/{creature_id}.xdb",
+                          f'<Creature><Cost><Gold>{10 * tier + up}</Gold></Cost><CreatureTown>{town}'
+                          f'</CreatureTown><CreatureTier>{tier}</CreatureTier><Upgrades>{ups}</Upgrades>'
+                          f'<Visual href="/GameMechanics/CreatureVisual/{creature_id}.xdb'
+                          f'#xpointer(/CreatureVisual)"/></Creature>')
+                _writestr(zf, f"GameMechanics/CreatureVisual/{creature_id}.xdb",
+                          f'<CreatureVisual><CreatureNameFileRef href="/Text/{creature_id}.txt"/>'
+                          f'</CreatureVisual>')
+    _writestr(zf, "GameMechanics/RefTables/Creatures.xdb", "<Table><objects>" + "".join(objs) + "</objects></Table>")
+
+
+def build(root: str, scale: FakeInstallScale = SCALES["small"]):
+    # Writes data/, UserMods/ and Maps/ of a fake install under root, the same bytes for the same scale
+    for d in ("data", "UserMods", "Maps"):
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    with ZipFile(os.path.join(root, "data", "data.pak"), "w", ZIP_DEFLATED) as zf:
+        _write_creatures(zf)
+        for cat in MAP_CATEGORIES:
+            for m in range(scale.maps):
+                _writestr(zf, f"Maps/{cat}/M{m}/map-tag.xdb", _MAP_TAG)
+                _writestr(zf, f"Maps/{cat}/M{m}/map.xdb", map_xdb(scale.objects * (m + 1)))
+        for h in range(scale.heroes):
+            _writestr(zf, f"MapObjects/Heroes/H{h}.(AdvMapHeroShared).xdb", hero_xdb(h))
+            _writestr(zf, f"MapObjects/Other/O{h}.(AdvMapStaticShared).xdb",
+                      b"<AdvMapStaticShared><X/></AdvMapStaticShared>")
+        _writestr(zf, "Text/irrelevant.txt", "x")
+        for i in range(scale.filler):
+            _writestr(zf, f"Textures/Filler/T{i}.dds", b"\0" * 64)
+
+    with ZipFile(os.path.join(root, "UserMods", "mods.h5u"), "w", ZIP_DEFLATED) as zf:
+        for chk in CHK_FILES:
+            _writestr(zf, "TTBerein/" + chk, "1")
+    with ZipFile(os.path.join(root, "UserMods", "irrelevant.h5u"), "w", ZIP_DEFLATED) as zf:
+        _writestr(zf, "Textures/a.dds", "x")
+
+    for m in range(scale.custom_maps):
+        with ZipFile(os.path.join(root, "Maps", f"C{m}.h5m"), "w", ZIP_DEFLATED) as zf:
+            _writestr(zf, f"Maps/Multiplayer/C{m}/map-tag.xdb", _MAP_TAG)
+            _writestr(zf, f"Maps/Multiplayer/C{m}/map.xdb", map_xdb(scale.objects))
+    with open(os.path.join(root, "Maps", "bad.h5m"), "wb") as fp:
+        fp.write(b"not a zip")
+    return root
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成用于测试和性能测量的假英雄无敌5安装文件夹")
+    parser.add_argument("root", help="生成的文件夹")
+    parser.add_argument("--scale", choices=tuple(SCALES), default="small")
+    for field in FakeInstallScale._fields:
+        parser.add_argument(f"--{field.replace('_', '-')}", type=int, default=None, dest=field)
+    args = parser.parse_args(argv)
+    scale = SCALES[args.scale]._replace(**{k: getattr(args, k) for k in FakeInstallScale._fields
+                                           if getattr(args, k) is not None})
+    build(args.root, scale)
+
+
+if __name__ == "__main__":
+    main()
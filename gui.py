@@ -1,6 +1,5 @@
 import logging
 from threading import Thread, Lock
-from queue import Queue, Empty
 from collections.abc import Callable
 from tkinter import END
 from tkinter import messagebox, Tk, Menu, scrolledtext, Toplevel, filedialog, LabelFrame, simpledialog
@@ -9,6 +8,8 @@ from tkinter.ttk import Label, Progressbar, Style, Checkbutton, Button
 from data_parser import (RawData, GameInfo, MapsStatusClass, HeroesStatusClass, HeroesStatusNames,PATCH_FILE_NAME,
                          remove_merged_patch)
 from persistence import per
+from log_ring import RingLogHandler
+from progress import ProgressChannel
 import data_parser as gg
 
 
@@ -59,16 +60,14 @@ class AboutWnd(simpledialog.Dialog):
 
 
 class LogWnd(Toplevel):
-    class _TextHandler(logging.Handler):
-        def __init__(self, queue):
-            super(LogWnd._TextHandler, self).__init__()
-            self.queue = queue
-        def emit(self, record):
-            self.queue.put(self.format(record))
+    # Lines kept by the handler and shown in the window, older ones are only in the log file
+    MAX_LINES = 2000
 
     def __init__(self, parent):
         super(LogWnd, self).__init__(parent)
-        self.queue = Queue()
+        self.handler = RingLogHandler(LogWnd.MAX_LINES)
+        self.seen = 0
+        self.refresh_job = None
         self.protocol("WM_DELETE_WINDOW", self.on_close)
         self.iconbitmap(per.get_ico())
 
@@ -79,30 +78,39 @@ class LogWnd(Toplevel):
         self.log_box = scrolledtext.ScrolledText(self, state='disabled', height=60, width=80)
         self.log_box.configure(font=('TkFixedFont', 11))
         self.log_box.grid(column=0, row=0, sticky="NEWS")
-        text_handler = LogWnd._TextHandler(self.queue)
-        logger = logging.getLogger()
-        logger.addHandler(text_handler)
-        self.after(0, self.append_msg)
+        logging.getLogger().addHandler(self.handler)
+        self.refresh_job = self.after(0, self.append_msg)
         self._parent = parent
 
     def append_msg(self):
-        msgs = []
-
-        while(True):
-            try:
-                msg = self.queue.get_nowait()
-                msgs.append(msg)
-            except Empty:
-                break
+        msgs, emitted = self.handler.since(self.seen, LogWnd.MAX_LINES)
 
         if len(msgs) > 0:
             msgs.append("")
             self.log_box.configure(state="normal")
+            if emitted - self.seen >= LogWnd.MAX_LINES:
+                self.log_box.delete("1.0", END)
             self.log_box.insert(END, "\n".join(msgs))
+            lines = int(self.log_box.index("end-1c").split(".")[0]) - 1
+            if lines > LogWnd.MAX_LINES:
+                self.log_box.delete("1.0", f"{lines - LogWnd.MAX_LINES + 1}.0")
             self.log_box.configure(state="disabled")
             self.log_box.yview(END)
+        self.seen = emitted
+
+        self.refresh_job = self.after(100, self.append_msg)
+
+    def withdraw(self):
+        # Nothing is formatted or drawn while hidden, the handler only keeps the newest records meanwhile
+        if self.refresh_job is not None:
+            self.after_cancel(self.refresh_job)
+            self.refresh_job = None
+        super(LogWnd, self).withdraw()
 
-        self.after(100, self.append_msg)
+    def deiconify(self):
+        super(LogWnd, self).deiconify()
+        if self.refresh_job is None:
+            self.append_msg()
 
     def on_close(self):
         per.log_x = self.winfo_x()
@@ -111,9 +119,17 @@ class LogWnd(Toplevel):
         self._parent._on_menu_showlog()
 
 class MainWnd(Tk):
+    # Milliseconds between two looks at the progress channel while a task runs
+    PROGRESS_INTERVAL = 50
+
     def __init__(self, *args):
         super(MainWnd, self).__init__(*args)
         self.lock = Lock()
+        # Workers publish to the channel, _on_progress drains it from the Tk loop while a handler is expected
+        self.progress = ProgressChannel()
+        self.progress_events = {}
+        self.progress_handler = None
+        self.progress_job = None
 
         font=("TkFixedFont", 11)
         sty = Style(self)
@@ -141,6 +157,9 @@ class MainWnd(Tk):
         per.main_x = self.winfo_x()
         per.main_y = self.winfo_y()
         per.save()
+        if self.progress_job is not None:
+            self.after_cancel(self.progress_job)
+            self.progress_job = None
         self.destroy()
 
     def _build_top_menu(self):
@@ -160,11 +179,11 @@ class MainWnd(Tk):
         self.attributes("-disabled", True)
         map_options = {k: MapsStatusClass(*("selected" in i.state() for i in v)) for k, v in self.map_checkboxes.items()}
         hero_options = HeroesStatusClass(*["selected" in i.state() for i in self.hero_checkboxes])
+        self._expect_progress(self._createmod_progress)
         Thread(target=self._creatmod_thread, args=(self.data, map_options, hero_options)).start()
         self.cancel_wnd = CancelWnd(self, self.data.cancel)
         self.cancel_wnd.update()
         self.cancel_wnd.deiconify()
-        self.after(10, self._createmod_thread_after, self.data)
 
     def _creatmod_thread(self, data: GameInfo, map_options: dict[str, MapsStatusClass[bool]],
                          hero_options: dict[str, bool]):
@@ -175,8 +194,34 @@ class MainWnd(Tk):
             gg.info = e
         except InterruptedError as e:
             gg.info = e
-
-    def _createmod_thread_after(self, data):
+        finally:
+            self.progress.publish("task", None, 1.0, finished=True)
+
+    def _expect_progress(self, handler: Callable):
+        self.progress.drain()
+        self.progress_events = {}
+        self.progress_handler = handler
+        if self.progress_job is None:
+            self.progress_job = self.after(MainWnd.PROGRESS_INTERVAL, self._on_progress)
+
+    def _on_progress(self):
+        # The handler clears progress_handler once its task finished, that ends the loop
+        self.progress_job = None
+        latest, finished = self.progress.drain()
+        self.progress_events.update(latest)
+        if self.progress_handler is not None:
+            self.progress_handler(finished)
+        if self.progress_handler is not None and self.progress_job is None:
+            self.progress_job = self.after(MainWnd.PROGRESS_INTERVAL, self._on_progress)
+
+    def _show_progress(self, status_text: str, prog_value: float):
+        prog_value = 100.00 if prog_value > 100.00 else prog_value
+        status_text = f"{status_text}, 总进度{prog_value:.2f}%"
+        status_text += (65 - len(status_text)) * " "
+        self.status_text.config(text=status_text)
+        self.status_prog.config(value=prog_value)
+
+    def _createmod_progress(self, finished: bool):
         def clean_up(finished_text):
             self.attributes("-disabled", False)
             self.status_prog.grid_forget()
@@ -184,6 +229,13 @@ class MainWnd(Tk):
             self.status_text.config(text=finished_text)
             self.cancel_wnd.destroy()
 
+        if not finished:
+            if "game" in self.progress_events:
+                event = self.progress_events["game"]
+                self._show_progress(event.stage, event.fraction * 100)
+            return
+
+        self.progress_handler = None
         with self.lock:
             if type(gg.info) == ValueError:
                 clean_up("生成兼容补丁失败")
@@ -194,18 +246,7 @@ class MainWnd(Tk):
                 clean_up("生成兼容补丁成功")
                 messagebox.showinfo(TITLE, "兼容补丁“UserMODS/" + PATCH_FILE_NAME + "”生成完成！")
             else:
-                status_text = ""
-                prog_value = 0.0
-
-                status_text = data.get_stage()
-                prog_value = data.get_progress() * 100
-
-                prog_value = 100.00 if prog_value > 100.00 else prog_value
-                status_text = f"{status_text}, 总进度{prog_value:.2f}%"
-                status_text += (65 - len(status_text)) * " "
-                self.status_text.config(text=status_text)
-                self.status_prog.config(value=prog_value)
-                self.after(10, self._createmod_thread_after, data)
+                clean_up("生成兼容补丁失败")
 
     def _on_menu_removemod(self):
         try:
@@ -300,30 +341,41 @@ class MainWnd(Tk):
         self.status_text.grid(column=0, row=self.num_rows, sticky="we", columnspan=1)
         self.status_prog.grid(column=1, row=self.num_rows, sticky="we")
         gg.info = None
-        raw_data = RawData(h5_path)
-        game_info = GameInfo()
+        raw_data = RawData(h5_path, progress=self.progress)
+        game_info = GameInfo(progress=self.progress)
+        self._expect_progress(self._ask_game_data_progress)
         Thread(target=self._ask_game_data_thread, args=(raw_data, game_info)).start()
-        self.after(10, self._ask_game_data_after, raw_data, game_info)
 
     def _ask_game_data_thread(self, raw_data: gg.RawData, game_info: GameInfo):
         try:
             raw_data.run()
+            game_info.preload(raw_data)
         except ValueError as e:
             with self.lock:
                 gg.info = e
             return
-
-        try:
-            game_info.preload(raw_data)
-        except ValueError as e:
+        else:
             with self.lock:
-                gg.info = e
+                gg.info = game_info
+        finally:
+            self.progress.publish("task", None, 1.0, finished=True)
+
+    def _ask_game_data_progress(self, finished: bool):
+        if not finished:
+            total_weight = RawData.get_time_weightage() + GameInfo.get_time_weightage()
+            if "game" in self.progress_events:
+                event = self.progress_events["game"]
+                prog_value = event.fraction * 100 * GameInfo.get_time_weightage() / total_weight \
+                    + RawData.get_time_weightage() * 100 / total_weight
+            elif "scan" in self.progress_events:
+                event = self.progress_events["scan"]
+                prog_value = event.fraction * 100 * RawData.get_time_weightage() / total_weight
+            else:
+                return
+            self._show_progress(event.stage, prog_value)
             return
 
-        with self.lock:
-            gg.info = game_info
-
-    def _ask_game_data_after(self, raw_data: gg.RawData, game_info: GameInfo):
+        self.progress_handler = None
         with self.lock:
             if type(gg.info) is ValueError:
                 self.withdraw()
@@ -337,23 +389,3 @@ class MainWnd(Tk):
                 self._build_top_menu()
                 self._build_main_frame()
                 #self._on_menu_createmod()
-            else:
-                status_text = ""
-                prog_value = 0.0
-                total_weight = RawData.get_time_weightage() + GameInfo.get_time_weightage()
-
-                if game_info.get_stage() is None:
-                    status_text = raw_data.get_stage()
-                    prog_value = raw_data.get_progress() * 100 * \
-                        RawData.get_time_weightage() / total_weight
-                else:
-                    status_text = game_info.get_stage()
-                    prog_value = game_info.get_progress() * 100 * GameInfo.get_time_weightage() / total_weight \
-                        + RawData.get_time_weightage() * 100 / total_weight
-
-                prog_value = 100.00 if prog_value > 100.00 else prog_value
-                status_text = f"{status_text}, 总进度{prog_value:.2f}%"
-                status_text += (65 - len(status_text)) * " "
-                self.status_text.config(text=status_text)
-                self.status_prog.config(value=prog_value)
-                self.after(10, self._ask_game_data_after, raw_data, game_info)
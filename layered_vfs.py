@@ -0,0 +1,95 @@
+import os
+import sys
+from collections import Counter, namedtuple
+
+from manifest_entry import ManifestEntry
+
+# priority is the scan order of the archive: data, then UserMods, then Maps, each folder in directory order
+Layer = namedtuple("Layer", ["priority", "folder", "zip_name"])
+Provider = namedtuple("Provider", ["zip_name", "date_time"])
+
+
+class LayeredVFS:
+    # Every scanned archive is a layer. Of the layers providing a path the one with the newest date_time wins,
+    # the higher priority among equal date_times. The winners are grouped by interned lowercased directory, so a
+    # folder's entries share one directory string and only their file names are kept per entry; a lookup is two
+    # dict accesses. The shadow index keeps, for every path more than one layer provides, the losing providers in
+    # precedence order.
+    def __init__(self, layers):
+        self.layers = {i.zip_name: i for i in layers}
+        self.winners = {}
+        self.count = 0
+        self.shadowed = {}
+
+    @staticmethod
+    def normalize(path: str):
+        # Lowercased, empty components dropped
+        path = path.lower()
+        if "//" in path or path.startswith("/") or path.endswith("/"):
+            path = "/".join(i for i in path.split("/") if i != "")
+        return path
+
+    def add(self, path: str, winner: ManifestEntry, losers=()):
+        # losers are the Providers the winner shadows, lowest precedence first
+        path = LayeredVFS.normalize(path)
+        folder, _, name = path.rpartition("/")
+        files = self.winners.get(folder)
+        if files is None:
+            files = self.winners[sys.intern(folder)] = {}
+        if name not in files:
+            self.count += 1
+        files[name] = winner
+        if len(losers) > 0:
+            self.shadowed[path] = tuple(losers)
+
+    def get(self, path: str, default=None):
+        folder, _, name = LayeredVFS.normalize(path).rpartition("/")
+        files = self.winners.get(folder)
+        return default if files is None else files.get(name, default)
+
+    def __getitem__(self, path: str):
+        result = self.get(path)
+        if result is None:
+            raise KeyError(path)
+        return result
+
+    def __contains__(self, path: str):
+        return self.get(path) is not None
+
+    def __len__(self):
+        return self.count
+
+    def providers(self, path: str):
+        # Archives providing path, lowest precedence first and the winner last; empty if nothing does
+        path = LayeredVFS.normalize(path)
+        winner = self.get(path)
+        if winner is None:
+            return []
+        return [i.zip_name for i in self.shadowed.get(path, ())] + [winner.zip_name]
+
+    def override_chains(self):
+        # (path, [providers, winner last]) of every path more than one archive provides
+        for path in sorted(self.shadowed):
+            yield path, self.providers(path)
+
+    def override_counts(self):
+        # {(winning archive, shadowed archive): number of paths}
+        result = Counter()
+        for path, losers in self.shadowed.items():
+            winner = self.get(path).zip_name
+            for i in losers:
+                result[(winner, i.zip_name)] += 1
+        return result
+
+    def layer_name(self, zip_name: str):
+        # The archive with the folder of its layer, archives in different folders may share a file name
+        return f"{self.layers[zip_name].folder}/{os.path.basename(zip_name)}"
+
+    def report(self, chains: bool = True):
+        lines = [f"{len(self.shadowed)}个文件被其他压缩文件覆盖"]
+        for (winner, loser), count in sorted(self.override_counts().items(), key=lambda x: (-x[1], x[0])):
+            lines.append(f"  {self.layer_name(winner)} 覆盖 {self.layer_name(loser)} 中的{count}个文件")
+        if chains:
+            for path, providers in self.override_chains():
+                lines.append(f"  {path}: " + " <- ".join(self.layer_name(i) for i in providers))
+        return "\n".join(lines)
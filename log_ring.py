@@ -0,0 +1,28 @@
+import logging
+from collections import deque
+from itertools import islice
+
+
+class RingLogHandler(logging.Handler):
+    # Keeps the newest capacity records as they are, a reader formats only the ones it is about to show.
+    # emitted counts every record ever handled, readers remember it to ask for what came after.
+    def __init__(self, capacity: int):
+        super(RingLogHandler, self).__init__()
+        self.records = deque(maxlen=capacity)
+        self.emitted = 0
+
+    def emit(self, record):
+        self.records.append(record)
+        self.emitted += 1
+
+    def since(self, seen: int, limit: int):
+        # Formatted messages of at most the newest limit records handled after the first seen ones,
+        # and the new value of seen
+        self.acquire()
+        try:
+            emitted = self.emitted
+            count = min(emitted - seen, len(self.records), limit)
+            records = list(islice(self.records, len(self.records) - count, None))
+        finally:
+            self.release()
+        return [self.format(i) for i in records], emitted
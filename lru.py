@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class BudgetLRU:
+    # Least recently used cache bounded by the summed weight of its values, by default their byte length
+    def __init__(self, budget: int, weigh=len):
+        self.budget = budget
+        self.weigh = weigh
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, loader=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key][0]
+            self.misses += 1
+        if loader is None:
+            return None
+        value = loader(key)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        weight = self.weigh(value)
+        with self._lock:
+            if key in self._items:
+                self.used -= self._items.pop(key)[1]
+            if weight <= self.budget:
+                self._items[key] = (value, weight)
+                self.used += weight
+            while self.used > self.budget:
+                _, (_, old_weight) = self._items.popitem(last=False)
+                self.used -= old_weight
+
+    def pop(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            value, weight = self._items.pop(key)
+            self.used -= weight
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
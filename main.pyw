@@ -1,4 +1,5 @@
 import logging
+import multiprocessing
 from zipfile import ZipFile
 
 from gui import MainWnd
@@ -14,5 +15,6 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
     #test()
@@ -0,0 +1,63 @@
+import logging
+import os
+import pickle
+from threading import Lock
+
+
+class ManifestCache:
+    FILE_NAME = "TTBereinH5ModManger.cache"
+    FORMAT = 1
+
+    def __init__(self, signature: tuple, file_name: str = FILE_NAME):
+        # signature holds everything that changes what a scan would keep (filters etc.), a mismatch drops the cache
+        self.signature = (ManifestCache.FORMAT, signature)
+        self.file_name = file_name
+        self.archives = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        self.archives = {}
+        if not os.path.isfile(self.file_name):
+            return
+        try:
+            with open(self.file_name, "rb") as fp:
+                signature, archives = pickle.load(fp)
+        except Exception:
+            logging.info("  清单缓存“%s”无法读取，将重新扫描", self.file_name)
+            return
+        if signature == self.signature:
+            self.archives = archives
+
+    def save(self, alive: set = None):
+        with self.lock:
+            if alive is not None:
+                self.archives = {k: v for k, v in self.archives.items() if k in alive}
+            tmp_name = self.file_name + ".tmp"
+            try:
+                with open(tmp_name, "wb") as fp:
+                    pickle.dump((self.signature, self.archives), fp, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_name, self.file_name)
+            except OSError:
+                logging.info("  清单缓存“%s”无法写入", self.file_name)
+
+    @staticmethod
+    def fingerprint(fullname: str):
+        st = os.stat(fullname)
+        return st.st_size, st.st_mtime_ns
+
+    def lookup(self, fullname: str, fingerprint: tuple):
+        # Returns (True, entries) on a hit, entries being () for irrelevant archives and None for broken ones
+        with self.lock:
+            cached = self.archives.get(fullname)
+            if cached is not None and cached[0] == fingerprint:
+                self.hits += 1
+                return True, cached[1]
+            self.misses += 1
+            return False, None
+
+    def store(self, fullname: str, fingerprint: tuple, entries):
+        with self.lock:
+            self.archives[fullname] = (fingerprint, None if entries is None else tuple(entries))
@@ -0,0 +1,51 @@
+import re
+
+from manifest_entry import ManifestEntry, kinds_mask
+
+# One match per entry name, lowercased: the groups say which bucket it goes to
+_ROUTES = re.compile(r"(?:(maps/[^/]+)/(?:.*/)?map-tag\.xdb"
+                     r"|(mapobjects/.*\.xdb)"
+                     r"|(gamemechanics/reftables/[^/]+)"
+                     r"|(ttberein/[^/]+\.chk))\Z", re.DOTALL)
+
+
+class ManifestClassifier:
+    # Routes the winning entries into the buckets the preload stages read, so none of them has to go through
+    # every file: map-tag files by maps/ subfolder and archive kind, hero candidates, RefTables tables and the
+    # TTBerein .chk markers. RawData._build_zip_list routes every winning entry once while it builds the VFS.
+    def __init__(self):
+        self.map_tags = {}
+        self.heroes = []
+        self.ref_tables = {}
+        self.markers = {}
+
+    def route(self, lower_name: str, entry: ManifestEntry):
+        matched = _ROUTES.match(lower_name)
+        if matched is None:
+            return
+        map_dir, hero, ref_table, marker = matched.groups()
+        if map_dir is not None:
+            self.map_tags.setdefault((map_dir, entry.kind), []).append(entry)
+        elif hero is not None:
+            self.heroes.append(entry)
+        elif ref_table is not None:
+            self.ref_tables[ref_table.rsplit("/", 1)[1]] = entry
+        else:
+            self.markers[marker.rsplit("/", 1)[1]] = entry
+
+    def map_tag_files(self, map_dir: str, zips_to_exclude=set()):
+        # The map-tag.xdb files below map_dir, leaving out the archive kinds in zips_to_exclude
+        exclude_mask = kinds_mask(zips_to_exclude)
+        map_dir = map_dir.lower().strip("/")
+        return sorted((i.name, i.zip_name) for (d, kind), entries in self.map_tags.items()
+                      if d == map_dir and kind & exclude_mask == 0 for i in entries)
+
+    def hero_files(self):
+        # The .xdb files below MapObjects/
+        return sorted((i.name, i.zip_name) for i in self.heroes)
+
+    def ref_table(self, name: str):
+        return self.ref_tables.get(name.lower())
+
+    def marker(self, name: str):
+        return self.markers.get(name.lower())
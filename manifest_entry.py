@@ -0,0 +1,33 @@
+ARCHIVE_KINDS = (".pak", ".h5u", ".h5m")
+
+
+def kind_of(zip_name: str):
+    try:
+        return 1 << ARCHIVE_KINDS.index(zip_name[-4:].lower())
+    except ValueError:
+        return 0
+
+
+def kinds_mask(suffixes):
+    result = 0
+    for i, suffix in enumerate(ARCHIVE_KINDS):
+        if suffix in suffixes:
+            result |= 1 << i
+    return result
+
+
+class ManifestEntry:
+    __slots__ = ("name", "zip_name", "kind")
+
+    def __init__(self, name: str, zip_name: str, kind: int):
+        self.name = name
+        self.zip_name = zip_name
+        self.kind = kind
+
+    def __iter__(self):
+        # Unpacks like the (true_name, zip_name) tuples the manifest used to hold
+        yield self.name
+        yield self.zip_name
+
+    def __repr__(self):
+        return f"ManifestEntry({self.name!r}, {self.zip_name!r})"
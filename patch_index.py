@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+from zipfile import BadZipFile, ZipFile
+
+from patch_writer import PatchWriter
+from zip_raw import read_raw
+
+
+class PatchIndex:
+    ENTRY_NAME = "TTBerein/TTBereinMergedPatch.idx"
+
+    def __init__(self, version: str, prev_patch: str = None):
+        # records: output key -> {"inputs": [...], "outputs": [entry names], "extra": anything json-able}
+        self.version = version
+        self.records = {}
+        self.reused = 0
+        self._prev_records = {}
+        self._prev_zip = None
+
+        if prev_patch is not None and os.path.isfile(prev_patch):
+            try:
+                self._prev_zip = ZipFile(prev_patch)
+                index = json.loads(self._prev_zip.read(PatchIndex.ENTRY_NAME))
+                if index["version"] == version:
+                    self._prev_records = index["records"]
+                else:
+                    logging.info("  旧补丁版本为%s，需完全重新生成", index['version'])
+            except (OSError, KeyError, ValueError, BadZipFile):
+                logging.info("  旧补丁“%s”中没有可用的索引，需完全重新生成", prev_patch)
+
+    @staticmethod
+    def _normalize(inputs):
+        return json.loads(json.dumps(inputs))
+
+    def reuse(self, key: str, inputs, zfp: PatchWriter):
+        # Copy the outputs of key from the previous patch as raw compressed bytes if its inputs did not change
+        record = self._prev_records.get(key)
+        if record is None or None in inputs or record["inputs"] != PatchIndex._normalize(inputs):
+            return None
+        try:
+            zinfos = [self._prev_zip.getinfo(i) for i in record["outputs"]]
+            raws = [read_raw(self._prev_zip, i) for i in zinfos]
+        except (KeyError, OSError, BadZipFile):
+            return None
+
+        for zinfo, raw in zip(zinfos, raws):
+            zfp.write_raw(zinfo, raw)
+        self.records[key] = record
+        self.reused += 1
+        return record
+
+    def record(self, key: str, inputs, outputs, extra=None):
+        # An input of None is unknown, the outputs are built again every time
+        if None in inputs:
+            return
+        self.records[key] = {"inputs": PatchIndex._normalize(inputs),
+                             "outputs": [i.replace(os.sep, "/") for i in outputs], "extra": extra}
+
+    def write(self, zfp: PatchWriter):
+        zfp.writestr(PatchIndex.ENTRY_NAME, json.dumps({"version": self.version, "records": self.records},
+                                                       ensure_ascii=False, sort_keys=True))
+
+    def close(self):
+        if self._prev_zip is not None:
+            self._prev_zip.close()
+            self._prev_zip = None
@@ -0,0 +1,140 @@
+import os
+import zlib
+from collections import deque
+from copy import copy
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+from tracing import tracer
+from zip_raw import write_raw
+
+CHUNK_SIZE = 1 << 20
+# Zip stores local times from 1980 to 2107 with two second steps
+_EARLIEST_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+_LATEST_DATE_TIME = (2107, 12, 31, 23, 59, 58)
+
+
+def patch_date_time(newest=None):
+    # Stamp of every patch entry: one step after newest, the newest date_time among the scanned entries, so the
+    # game prefers the patch to each file it replaces, and the same inputs give the same archive
+    if newest is None:
+        return _EARLIEST_DATE_TIME
+    try:
+        result = datetime(*newest) + timedelta(seconds=2)
+    except (ValueError, OverflowError):
+        # A damaged header can hold any date, the latest one still comes after it
+        return _LATEST_DATE_TIME
+    return min(result.timetuple()[:6], _LATEST_DATE_TIME)
+
+
+def _compress(name: str, data: bytes, compress_type: int, level: int, cancel=None):
+    # Runs in the pool, zlib releases the GIL while it works. Same stream as ZipFile.writestr produces,
+    # fed a chunk at a time so a set cancel Event stops it between chunks.
+    with tracer.span("compress", "zip", file=name):
+        crc = zlib.crc32(data)
+        if compress_type != ZIP_DEFLATED:
+            return crc, data
+        compressor = zlib.compressobj(9 if level is None else level, zlib.DEFLATED, -15)
+        view = memoryview(data)
+        parts = []
+        for i in range(0, len(view), CHUNK_SIZE):
+            if cancel is not None and cancel.is_set():
+                raise InterruptedError
+            parts.append(compressor.compress(view[i:i + CHUNK_SIZE]))
+        parts.append(compressor.flush())
+        return crc, b"".join(parts)
+
+
+class PatchWriter:
+    # Stands in for ZipFile.writestr while a patch is built: entries are compressed by a thread pool and
+    # appended by the calling thread in the order they were given, so the archive doesn't depend on scheduling.
+    # At most max_pending_bytes of payload wait for compression before writestr blocks on the oldest entry.
+    # Setting cancel, an Event, makes compressing and waiting raise InterruptedError.
+    MAX_PENDING_BYTES = 128 * 1024 * 1024
+
+    def __init__(self, zf: ZipFile, workers: int = None, max_pending_bytes: int = MAX_PENDING_BYTES, cancel=None,
+                 date_time: tuple = _EARLIEST_DATE_TIME):
+        self.zf = zf
+        self.cancel = cancel
+        self.date_time = date_time
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending_bytes = max_pending_bytes
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self.pending = deque()
+        self.pending_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        self.close()
+
+    def writestr(self, name: str, data, source: str = ""):
+        # source is what the entry is counted under in the tracer's bytes_compressed
+        zinfo = ZipInfo(name, date_time=self.date_time)
+        zinfo.compress_type = self.zf.compression
+        zinfo.external_attr = 0o600 << 16
+        if isinstance(data, str):
+            data = data.encode("utf8")
+
+        zinfo.file_size = len(data)
+        if self.executor is None:
+            zinfo.CRC, raw = _compress(name, data, zinfo.compress_type, self.zf.compresslevel, self.cancel)
+            zinfo.compress_size = len(raw)
+            with tracer.span("zip_write", "zip", file=name):
+                write_raw(self.zf, zinfo, raw)
+            tracer.count("bytes_compressed", zinfo.compress_size, source)
+            return
+
+        future = self.executor.submit(_compress, name, data, zinfo.compress_type, self.zf.compresslevel,
+                                      self.cancel)
+        self.pending.append((zinfo, future, source))
+        self.pending_bytes += len(data)
+        self._drain()
+
+    def write_raw(self, zinfo: ZipInfo, raw: bytes):
+        # An entry copied as stored from another archive, kept in line with the entries still compressing. It gets
+        # this patch's date_time, the one it had may be older than a source added since with the same content.
+        zinfo = copy(zinfo)
+        zinfo.date_time = self.date_time
+        if self.executor is None:
+            write_raw(self.zf, zinfo, raw)
+        else:
+            self.pending.append((zinfo, raw, None))
+            self._drain()
+
+    def _drain(self, wait_all: bool = False):
+        # Appends finished entries from the front of the queue, waiting for unfinished ones only while the
+        # backlog is over budget or with wait_all
+        while len(self.pending) > 0:
+            zinfo, payload, source = self.pending[0]
+            if isinstance(payload, bytes):
+                write_raw(self.zf, zinfo, payload)
+            else:
+                if not payload.done() and not (wait_all or self.pending_bytes > self.max_pending_bytes):
+                    return
+                while not payload.done():
+                    wait((payload, ), timeout=0.05)
+                    if self.cancel is not None and self.cancel.is_set():
+                        raise InterruptedError
+                zinfo.CRC, raw = payload.result()
+                zinfo.compress_size = len(raw)
+                self.pending_bytes -= zinfo.file_size
+                with tracer.span("zip_write", "zip", file=zinfo.filename):
+                    write_raw(self.zf, zinfo, raw)
+                tracer.count("bytes_compressed", zinfo.compress_size, source)
+            self.pending.popleft()
+
+    def flush(self):
+        self._drain(wait_all=True)
+
+    def close(self):
+        # Entries not flushed yet are dropped, as after a cancelled build
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        self.pending.clear()
+        self.pending_bytes = 0
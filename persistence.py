@@ -5,11 +5,16 @@ import uuid
 import itertools
 from copy import deepcopy
 
+from xml_edit import serialize_element
+
 class Persistence:
     FILE_NAME = "TTBereinH5ModManger.ini"
     VERSION = "0.52"
     TOWNS = ("RABMiniAcademy", "RABMiniFortress", "RABMiniHaven", "RABMiniInferno", "RABMiniPreserve",
              "RABMiniStronghold", "RABMiniWarMachineFactory")
+    # Items of a map's "objects" sit two levels below the root
+    OBJECTS_ITEM_LEVEL = 2
+    _ID_PLACEHOLDER = "TTBereinItemId"
 
     def __init__(self):
         if os.path.isfile(Persistence.FILE_NAME):
@@ -30,6 +35,7 @@ class Persistence:
         self._specialization_swaps = {}
         self._artificer_artefact_skeleton = None
         self._artificer_artefact_names = {}
+        self._fragments = {}
 
         self._get_resource_path()
         self._load_towns_spells_artifacts()
@@ -51,23 +57,41 @@ class Persistence:
     def get_xml(self, xml_name):
         return open(self._get_file(xml_name)).read()
 
-    def get_7za(self):
-        return self._get_file("7z.exe")
-
     def get_ico(self):
         return self._get_file("Angel.ico")
 
-    def get_artificer_artefact_xdb(self, name):
+    @staticmethod
+    def new_item_id(seed: str = None):
+        # Random without a seed, the same seed always gives the same id so builds can be repeated byte for byte
+        item_uuid = uuid.uuid4() if seed is None else uuid.uuid5(uuid.NAMESPACE_OID, seed)
+        return "item_{}".format(str(item_uuid).upper())
+
+    def get_artificer_artefact_xdb(self, name, item_id=None):
         spell_id, artefact_href = self._artificer_artefact_names[name]
-        new_uuid = "item_{}".format(str(uuid.uuid4()).upper())
         result = deepcopy(self._artificer_artefact_skeleton)
-        result.attrib["id"] = new_uuid
+        result.attrib["id"] = Persistence.new_item_id() if item_id is None else item_id
         adv_arti_et = result.find("AdvMapArtifact")
         adv_arti_et.find("Name").text = name
         adv_arti_et.find("Shared").attrib["href"] = artefact_href
         adv_arti_et.find("spellID").text = spell_id
         return result
 
+    def get_rab_fragment(self, town, level=OBJECTS_ITEM_LEVEL):
+        key = ("rab", town, level)
+        if key not in self._fragments:
+            self._fragments[key] = serialize_element(self._rab_xdbs[town], level)
+        return self._fragments[key]
+
+    def get_artificer_artefact_fragment(self, name, seed=None, level=OBJECTS_ITEM_LEVEL):
+        # Serialized once per artefact, every copy only gets its own item id, derived from seed and name if
+        # seed is given
+        key = ("artificer", name, level)
+        if key not in self._fragments:
+            et = self.get_artificer_artefact_xdb(name, Persistence._ID_PLACEHOLDER)
+            self._fragments[key] = serialize_element(et, level).split(Persistence._ID_PLACEHOLDER, 1)
+        head, tail = self._fragments[key]
+        return head + Persistence.new_item_id(None if seed is None else f"{seed}/{name}") + tail
+
     def _load_towns_spells_artifacts(self):
         self._rab_xdbs = {i: ET.fromstring(self.get_xml(i + ".xml")) for i in Persistence.TOWNS}
         self._all_artefacts_set = set(i.text for i in ET.fromstring(self.get_xml("AllArtefactsNoAdventure.xml")))
@@ -119,7 +143,7 @@ class Persistence:
     def all_artefacts_set(self):
         return self._all_artefacts_set
 
-    property
+    @property
     def all_spells_set(self):
         return self._all_spells_set
 
@@ -0,0 +1,38 @@
+from collections import namedtuple
+from queue import SimpleQueue, Empty
+from time import monotonic
+
+# finished marks the last event of a task, its outcome is left where the task stores it
+ProgressEvent = namedtuple("ProgressEvent", ["source", "stage", "fraction", "finished"], defaults=(False, ))
+
+
+class ProgressChannel:
+    # Workers publish progress without waiting on anything the consumer holds: events go to a SimpleQueue,
+    # at most one per interval seconds and source unless the stage changes or the task finishes.
+    # The consumer drains the queue on its own schedule, the GUI from a Tk after loop, so no other thread
+    # ever has to call into Tk.
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self._queue = SimpleQueue()
+        self._last = {}
+
+    def publish(self, source: str, stage: str, fraction: float, finished: bool = False):
+        now = monotonic()
+        last = self._last.get(source)
+        if not finished and last is not None and last[0] == stage and now - last[1] < self.interval:
+            return
+        self._last[source] = (stage, now)
+        self._queue.put(ProgressEvent(source, stage, fraction, finished))
+
+    def drain(self):
+        # Latest event of every source published since the last drain, and whether any of them finished a task
+        latest = {}
+        finished = False
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except Empty:
+                break
+            latest[event.source] = event
+            finished |= event.finished
+        return latest, finished
@@ -0,0 +1,65 @@
+import logging
+import os
+import pickle
+from threading import Lock
+
+
+class RootTagIndex:
+    FILE_NAME = "TTBereinH5ModManger.tags"
+    FORMAT = 1
+    UNKNOWN = object()
+
+    def __init__(self, file_name: str = FILE_NAME):
+        # (archive, entry name, CRC32) -> root tag of the entry, None if it isn't a readable xml
+        self.file_name = file_name
+        self.tags = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        self.tags = {}
+        if not os.path.isfile(self.file_name):
+            return
+        try:
+            with open(self.file_name, "rb") as fp:
+                file_format, tags = pickle.load(fp)
+        except Exception:
+            logging.info("  根标签索引“%s”无法读取，将重新识别", self.file_name)
+            return
+        if file_format == RootTagIndex.FORMAT:
+            self.tags = tags
+
+    def save(self, alive: set = None):
+        with self.lock:
+            if alive is not None:
+                pruned = {k: v for k, v in self.tags.items() if k[0] in alive}
+                self.dirty |= len(pruned) != len(self.tags)
+                self.tags = pruned
+            if not self.dirty:
+                return
+            tmp_name = self.file_name + ".tmp"
+            try:
+                with open(tmp_name, "wb") as fp:
+                    pickle.dump((RootTagIndex.FORMAT, self.tags), fp, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_name, self.file_name)
+                self.dirty = False
+            except OSError:
+                logging.info("  根标签索引“%s”无法写入", self.file_name)
+
+    def get(self, key: tuple):
+        with self.lock:
+            result = self.tags.get(key, RootTagIndex.UNKNOWN)
+            if result is RootTagIndex.UNKNOWN:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def put(self, key: tuple, tag):
+        with self.lock:
+            if self.tags.get(key, RootTagIndex.UNKNOWN) != tag:
+                self.tags[key] = tag
+                self.dirty = True
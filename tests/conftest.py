@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# The modules sit at the top of the repository, and Persistence loads its resources from the working directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import cli
+from data_parser import PATCH_FILE_NAME
+from fake_install import build
+
+
+@pytest.fixture
+def fake_root(tmp_path):
+    return build(str(tmp_path / "h5"))
+
+
+@pytest.fixture
+def build_patch():
+    # Runs the command line build on root without the caches next to the repository, returns the patch path
+    def _build(root: str, *options: str):
+        report = cli.run(cli.build_parser().parse_args([root, "--no-cache", *options]))
+        assert report["ok"], report["error"]
+        return os.path.join(root, "UserMODs", PATCH_FILE_NAME)
+    return _build
@@ -0,0 +1,85 @@
+import random
+import sqlite3
+from zipfile import ZipFile
+
+from creature_table import CreatureInfo, CreatureTable
+from data_parser import CREATURE_INFO, TOWN_VALUE, GameInfo, RawData
+
+# The queries the creature Lua tables were generated with before CreatureTable, kept as the reference
+_QUERIES = {
+    "CREATURE2TEXT": "SELECT id, text FROM infos ORDER BY town_value, tier, upgrade, id",
+    "CREATURE2COST": "SELECT id, cost FROM infos ORDER BY town_value, tier, upgrade, id",
+    "CREATURE2TIER": "SELECT id, tier FROM infos ORDER BY town_value, tier, upgrade, id",
+    "CREATURE2TOWN": "SELECT id, town FROM infos ORDER BY town_value, tier, upgrade, id",
+    "CREATURE2GRADE": "SELECT id, upgrade FROM infos ORDER BY town_value, tier, upgrade, id",
+    "CREATURE_UPGRADE2UNGRADED": """
+        SELECT upgraded, ungraded FROM
+            (SELECT u.upgrade1 AS upgraded, u.ungraded AS ungraded, i.town_value, i.tier, i.upgrade
+             FROM upgrades u JOIN infos i ON i.id = u.upgrade1
+             UNION
+             SELECT u.upgrade2 AS upgraded, u.ungraded AS ungraded, i.town_value, i.tier, i.upgrade
+             FROM upgrades u JOIN infos i ON i.id = u.upgrade2)
+        ORDER BY town_value, tier, upgrade""",
+    "CREATURE_UNGRADE2UPGRADED[1]": """
+        SELECT i.id, u.upgrade1 FROM infos i JOIN upgrades u ON i.id = u.ungraded
+        ORDER BY i.town_value, i.tier, i.upgrade""",
+    "CREATURE_UNGRADE2UPGRADED[2]": """
+        SELECT i.id, u.upgrade2 FROM infos i JOIN upgrades u ON i.id = u.ungraded
+        ORDER BY i.town_value, i.tier, i.upgrade""",
+}
+
+
+def _sqlite_lua(table: CreatureTable, town_values: dict):
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE infos (id TEXT PRIMARY KEY, cost INTEGER, tier INTEGER, town TEXT, "
+                 "town_value INTEGER, text TEXT, upgrade INTEGER DEFAULT 0)")
+    conn.execute("CREATE TABLE upgrades (ungraded TEXT, upgrade1 TEXT, upgrade2 TEXT)")
+    conn.executemany("INSERT INTO infos (id, cost, tier, town, town_value, text) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(k, v.cost, v.tier, v.town, town_values[v.town], v.text) for k, v in table.infos.items()])
+    for line in table.upgrade_lines:
+        for grade, creature_id in enumerate(line):
+            conn.execute("UPDATE infos SET upgrade = ? WHERE id = ?", (grade, creature_id))
+    conn.executemany("INSERT INTO upgrades VALUES (?, ?, ?)", table.upgrade_lines)
+
+    lines = []
+    for var_name, query in _QUERIES.items():
+        if var_name == "CREATURE_UNGRADE2UPGRADED[1]":
+            lines.extend(("CREATURE_UNGRADE2UPGRADED = {[1] = {}, [2] = {}}", ""))
+        rows = conn.execute(query).fetchall()
+        value = rows[0][1]
+        quoted = isinstance(value, str) and not value.startswith("CREATURE_") and not value.startswith("TOWN_")
+        format_string = "    [{}] = \"{}\"," if quoted else "    [{}] = {},"
+        lines.append("{} = {{".format(var_name))
+        lines.extend(format_string.format(i, j) for i, j in rows)
+        lines.extend(("}", ""))
+    conn.close()
+    return "\n".join(lines)
+
+
+def test_lua_matches_sqlite_on_random_tables():
+    # Few towns, tiers and costs so most creatures tie on everything but the id
+    town_values = {"TOWN_A": 0, "TOWN_B": 1, "TOWN_NEUTRAL": 1}
+    for seed in range(300):
+        rng = random.Random(seed)
+        ids = rng.sample([f"CREATURE_{i}" for i in range(200)], rng.randint(3, 40))
+        table = CreatureTable()
+        for creature_id in ids:
+            upgrades = tuple(rng.choice(ids + ["CREATURE_999"]) for _ in range(2)) if rng.random() < 0.5 else ()
+            table.add(creature_id, CreatureInfo(rng.choice(list(town_values)), rng.randint(1, 5),
+                                                rng.choice(["/Text/a.txt", "x", "CREATURE_T"]), rng.randint(1, 3),
+                                                upgrades))
+        named_ups = [i for i in table.upgrade_lines if i[1] in table.infos or i[2] in table.infos]
+        if len(named_ups) == 0:
+            # sqlite had no rows to tell the value format from
+            continue
+        assert table.build(town_values).lua() == _sqlite_lua(table, town_values), seed
+
+
+def test_fake_install_lua_matches_sqlite(fake_root, build_patch):
+    data = RawData(fake_root, use_cache=False)
+    data.run()
+    game_info = GameInfo()
+    game_info.preload(data)
+    expected = _sqlite_lua(game_info.creature_table, TOWN_VALUE)
+    with ZipFile(build_patch(fake_root, "--full")) as zf:
+        assert zf.read(CREATURE_INFO).decode() == expected
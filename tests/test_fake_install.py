@@ -0,0 +1,19 @@
+import os
+
+from fake_install import build
+
+
+def _files(root: str):
+    result = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            with open(os.path.join(folder, name), "rb") as fp:
+                result[os.path.relpath(os.path.join(folder, name), root)] = fp.read()
+    return result
+
+
+def test_same_scale_gives_same_bytes(tmp_path, monkeypatch):
+    first = _files(build(str(tmp_path / "a")))
+    # A later wall clock must not show up in the archives
+    monkeypatch.setattr("time.time", lambda: 2e9)
+    assert _files(build(str(tmp_path / "b"))) == first
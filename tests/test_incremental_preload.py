@@ -0,0 +1,34 @@
+import os
+from zipfile import ZipFile
+
+from data_parser import GameInfo, RawData
+
+MAP_TAG = "Maps/Multiplayer/C0/map-tag.xdb"
+
+
+def _preload(root: str):
+    data = RawData(root, use_cache=False, keep_scanned=True)
+    data.run()
+    return data, GameInfo(map_workers=0).preload(data)
+
+
+def test_refresh_reads_only_paths_from_changed_archives(fake_root, monkeypatch):
+    data, game_info = _preload(fake_root)
+    creature_id, record = next(iter(game_info.creature_records.items()))
+
+    # A mod moving one map-tag file and one creature with a new cost to another archive
+    mod = os.path.join(fake_root, "UserMods", "zz.h5u")
+    with ZipFile(mod, "w") as zf:
+        zf.writestr(MAP_TAG, data.get_file(MAP_TAG))
+        zf.writestr(record.obj, data.get_file(record.obj).replace(b"<Gold>", b"<Gold>9"))
+    reads = []
+    peek_values = data.peek_values
+    monkeypatch.setattr(data, "peek_values", lambda target, *args: reads.append(target) or peek_values(target, *args))
+    data.refresh({mod})
+    game_info.preload(data, {mod})
+    assert sorted(reads) == sorted([MAP_TAG, record.obj, record.visual])
+
+    _, expected = _preload(fake_root)
+    assert game_info.map_xdbs == expected.map_xdbs
+    assert game_info.creature_table.lua() == expected.creature_table.lua()
+    assert game_info.creature_records[creature_id].info.cost != record.info.cost
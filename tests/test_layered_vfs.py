@@ -0,0 +1,14 @@
+from layered_vfs import Layer, LayeredVFS, Provider
+from manifest_entry import ManifestEntry, kind_of
+
+
+def test_report_names_the_layer_folders():
+    # The same archive name in two folders stays apart in the report
+    layers = [Layer(0, "data", "/h5/data/a.pak"), Layer(1, "UserMods", "/h5/UserMods/a.pak")]
+    vfs = LayeredVFS(layers)
+    winner = layers[1].zip_name
+    vfs.add("Maps/x.xdb", ManifestEntry("Maps/x.xdb", winner, kind_of(winner)),
+            [Provider(layers[0].zip_name, (2006, 1, 1, 0, 0, 0))])
+    assert vfs.report().splitlines() == ["1个文件被其他压缩文件覆盖",
+                                         "  UserMods/a.pak 覆盖 data/a.pak 中的1个文件",
+                                         "  maps/x.xdb: data/a.pak <- UserMods/a.pak"]
@@ -0,0 +1,38 @@
+import xml.etree.ElementTree as ET
+from zipfile import ZipFile
+
+import pytest
+
+from patch_index import PatchIndex
+
+# Every option on, and a mix with a category left out
+MAP_OPTIONS = {
+    "all": (),
+    "mixed": ("--maps", "scenario=none", "--maps", "singlemissions=all_heroes",
+              "--maps", "multiplayer=all_spells_artefacts,racial_ability_boost"),
+}
+
+
+def _build(build_patch, root: str, engine: str, options):
+    # {entry: content} of a full build, without the index whose inputs name the engine
+    with ZipFile(build_patch(root, "--full", "--map-workers", "0", "--map-engine", engine, *options)) as zf:
+        return {i: zf.read(i) for i in zf.namelist() if i != PatchIndex.ENTRY_NAME}
+
+
+@pytest.mark.parametrize("options", MAP_OPTIONS.values(), ids=MAP_OPTIONS.keys())
+def test_stream_engine_matches_tree(fake_root, build_patch, options):
+    tree = _build(build_patch, fake_root, "tree", options)
+    assert _build(build_patch, fake_root, "stream", options) == tree
+
+
+@pytest.mark.parametrize("options", MAP_OPTIONS.values(), ids=MAP_OPTIONS.keys())
+def test_edit_engine_matches_tree_semantically(fake_root, build_patch, options):
+    # The edit engine keeps the source formatting, so its maps are compared as canonical xml without whitespace
+    tree = _build(build_patch, fake_root, "tree", options)
+    edit = _build(build_patch, fake_root, "edit", options)
+    assert edit.keys() == tree.keys()
+    for name, content in tree.items():
+        if name.endswith("/map.xdb"):
+            assert ET.canonicalize(edit[name], strip_text=True) == ET.canonicalize(content, strip_text=True), name
+        else:
+            assert edit[name] == content, name
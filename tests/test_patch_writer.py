@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import sys
+from zipfile import ZipFile, ZipInfo
+
+from conftest import ROOT
+from patch_index import PatchIndex
+from patch_writer import patch_date_time
+
+
+def _entries(patch: str):
+    with ZipFile(patch) as zf:
+        return {i.filename: (i.date_time, zf.read(i)) for i in zf.infolist()}
+
+
+def test_patch_date_time():
+    assert patch_date_time((2020, 12, 31, 23, 59, 58)) == (2021, 1, 1, 0, 0, 0)
+    assert patch_date_time(None) == (1980, 1, 1, 0, 0, 0)
+    assert patch_date_time((2107, 12, 31, 23, 59, 58)) == (2107, 12, 31, 23, 59, 58)
+    assert patch_date_time((2020, 0, 0, 0, 0, 0)) == (2107, 12, 31, 23, 59, 58)
+
+
+def test_full_builds_are_byte_identical(fake_root, build_patch):
+    patch = build_patch(fake_root, "--full", "--map-workers", "0", "--compress-workers", "1")
+    with open(patch, "rb") as fp:
+        serial = fp.read()
+    os.remove(patch)
+
+    # Another process with another hash seed, so set ordering would show up as well
+    subprocess.run([sys.executable, os.path.join(ROOT, "cli.py"), fake_root, "--no-cache", "--full",
+                    "--map-workers", "2", "--compress-workers", "4"],
+                   cwd=ROOT, env={**os.environ, "PYTHONHASHSEED": "1"}, check=True, capture_output=True)
+    with open(patch, "rb") as fp:
+        assert fp.read() == serial
+
+
+def test_incremental_build_has_same_entries(fake_root, build_patch):
+    # Reused entries keep the order of the previous patch, so only the entry set and contents are the same
+    full = _entries(build_patch(fake_root, "--full", "--map-workers", "0"))
+    assert _entries(build_patch(fake_root, "--map-workers", "2")) == full
+
+
+def test_reused_entries_get_the_new_date_time(fake_root, build_patch):
+    # A mod shipping an unchanged map with a newer date must not win over the reused patch entry
+    build_patch(fake_root, "--map-workers", "0")
+    name = "Maps/Scenario/M0/map.xdb"
+    with ZipFile(os.path.join(fake_root, "data", "data.pak")) as zf:
+        content = zf.read(name)
+    newer = (2030, 1, 1, 0, 0, 0)
+    with ZipFile(os.path.join(fake_root, "UserMods", "zz.h5u"), "w") as zf:
+        zf.writestr(ZipInfo(name, date_time=newer), content)
+
+    with ZipFile(build_patch(fake_root, "--map-workers", "0")) as zf:
+        index = json.loads(zf.read(PatchIndex.ENTRY_NAME))
+        assert name in index["records"]
+        assert set(i.date_time for i in zf.infolist()) == {patch_date_time(newer)}
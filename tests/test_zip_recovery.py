@@ -0,0 +1,61 @@
+import json
+import os
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from data_parser import RawData
+from fake_install import SCALES, map_xdb
+from patch_index import PatchIndex
+
+C0_MAP = "Maps/Multiplayer/C0/map.xdb"
+
+
+class _Stream:
+    # A file object without tell or seek, ZipFile writes every entry with a data descriptor into it
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _damage(path: str):
+    # Rewrites the archive the way a streaming writer does, then cuts off its central directory
+    with ZipFile(path) as zf:
+        contents = [(i.filename, zf.read(i)) for i in zf.infolist()]
+    stream = _Stream()
+    with ZipFile(stream, "w", ZIP_DEFLATED) as zf:
+        for name, data in contents:
+            zf.writestr(name, data)
+    data = b"".join(stream.parts)
+    with open(path, "wb") as fp:
+        fp.write(data[:data.index(b"PK\x01\x02")])
+
+
+def test_damaged_archive_is_read_without_its_directory(fake_root, monkeypatch):
+    _damage(os.path.join(fake_root, "Maps", "C0.h5m"))
+    data = RawData(fake_root, use_cache=False)
+    data.run()
+
+    def _directory(zip_name):
+        raise AssertionError(f"{zip_name} parsed again")
+    monkeypatch.setattr(data.zip_pool, "directory", _directory)
+    assert data.get_file(C0_MAP) == map_xdb(SCALES["small"].objects)
+    with data.open_file(C0_MAP) as fp:
+        assert fp.read() == map_xdb(SCALES["small"].objects)
+    assert data.get_info(C0_MAP).CRC is None
+    assert data.get_fingerprint(C0_MAP) is None
+
+
+def test_entry_with_unknown_fingerprint_is_never_reused(fake_root, build_patch):
+    _damage(os.path.join(fake_root, "Maps", "C0.h5m"))
+    builds = []
+    for _ in range(2):
+        with ZipFile(build_patch(fake_root, "--map-workers", "0")) as zf:
+            records = json.loads(zf.read(PatchIndex.ENTRY_NAME))["records"]
+            builds.append(zf.read(C0_MAP))
+        assert C0_MAP not in records and "Maps/Multiplayer/C1/map.xdb" in records
+    assert builds[0] == builds[1]
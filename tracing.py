@@ -0,0 +1,162 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import tracemalloc
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager, nullcontext
+from threading import Lock, get_ident
+from time import perf_counter
+
+TraceSpan = namedtuple("TraceSpan", ["name", "cat", "start", "duration", "pid", "tid", "args"])
+_NO_SPAN = nullcontext()
+
+
+class Tracer:
+    # Spans and counters of a pipeline run. Off by default, so span() and count() cost one attribute check.
+    # Span start times are perf_counter() values, which are comparable across the map worker processes.
+    # Counters are broken down by source, normally the archive the data came from.
+    def __init__(self):
+        self.enabled = False
+        self.profile_stages = frozenset()
+        self.tracemalloc_stages = frozenset()
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self.counters = defaultdict(lambda: defaultdict(float))
+            self.profiles = {}
+            self.memory = {}
+            self.origin = perf_counter()
+
+    def enable(self, profile_stages=(), tracemalloc_stages=()):
+        # Span names listed in profile_stages get a cProfile capture, those in tracemalloc_stages the peak and
+        # top allocations made while they ran
+        self.profile_stages = frozenset(profile_stages)
+        self.tracemalloc_stages = frozenset(tracemalloc_stages)
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name: str, cat: str = "stage", **args):
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name, cat, args)
+
+    @contextmanager
+    def _span(self, name: str, cat: str, args: dict):
+        profiler = None
+        if name in self.profile_stages:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler, an enclosing stage's one included, is already running
+                profiler = None
+        started_tracemalloc = False
+        if name in self.tracemalloc_stages:
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            snapshot_before = tracemalloc.take_snapshot()
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                text = io.StringIO()
+                pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(30)
+                self.profiles[name] = text.getvalue()
+            if name in self.tracemalloc_stages:
+                _, peak = tracemalloc.get_traced_memory()
+                top = tracemalloc.take_snapshot().compare_to(snapshot_before, "lineno")[:10]
+                self.memory[name] = {"peak": peak, "top": [str(i) for i in top]}
+                if started_tracemalloc:
+                    tracemalloc.stop()
+            self.add_span(name, cat, start, duration, args=args)
+
+    def add_span(self, name: str, cat: str, start: float, duration: float, pid: int = None, tid: int = None,
+                 args: dict = None):
+        # For work timed elsewhere, e.g. maps transformed in a worker process
+        if not self.enabled:
+            return
+        span = TraceSpan(name, cat, start, duration, os.getpid() if pid is None else pid,
+                         get_ident() if tid is None else tid, args or {})
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name: str, value: float, source: str = ""):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name][source] += value
+
+    def totals(self):
+        with self._lock:
+            return {k: sum(v.values()) for k, v in self.counters.items()}
+
+    def chrome_trace(self):
+        # Trace Event Format, loadable by chrome://tracing and Perfetto
+        with self._lock:
+            spans = list(self.spans)
+            counters = {k: dict(v) for k, v in self.counters.items()}
+        events = [{"name": i.name, "cat": i.cat, "ph": "X", "ts": (i.start - self.origin) * 1e6,
+                   "dur": i.duration * 1e6, "pid": i.pid, "tid": i.tid, "args": i.args} for i in spans]
+        events.sort(key=lambda x: (x["ts"], -x["dur"]))
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"counters": counters, "memory": self.memory}}
+
+    def export_chrome(self, file_name: str):
+        with open(file_name, "w", encoding="utf8") as fp:
+            json.dump(self.chrome_trace(), fp, ensure_ascii=False)
+
+    def _slowest(self, cat: str, top: int):
+        with self._lock:
+            spans = [i for i in self.spans if i.cat == cat]
+        return sorted(spans, key=lambda x: x.duration, reverse=True)[:top]
+
+    def summary(self, top: int = 10):
+        # Plain text tables of the stages, the slowest archives, maps and heroes, and the counters by archive
+        lines = []
+
+        def _table(title, spans):
+            if len(spans) == 0:
+                return
+            lines.append(title)
+            for i in spans:
+                label = i.args.get("file") or i.args.get("archive") or i.name
+                lines.append(f"  {i.duration:10.3f}s  {label}")
+
+        with self._lock:
+            stages = [i for i in self.spans if i.cat == "stage"]
+        _table("阶段耗时", stages)
+        _table("扫描最慢的压缩文件", self._slowest("archive", top))
+        _table("处理最慢的地图", self._slowest("map", top))
+        _table("处理最慢的英雄", self._slowest("hero", top))
+
+        with self._lock:
+            counters = {k: dict(v) for k, v in self.counters.items()}
+        for name, sources in sorted(counters.items()):
+            lines.append(f"{name}: 共{sum(sources.values()):.3f}")
+            for source, value in sorted(sources.items(), key=lambda x: x[1], reverse=True)[:top]:
+                lines.append(f"  {value:16.3f}  {source or '-'}")
+
+        for name, memory in self.memory.items():
+            lines.append(f"{name}内存峰值{memory['peak'] / 1048576:.1f}MB")
+            lines.extend("  " + i for i in memory["top"])
+        for name, text in self.profiles.items():
+            lines.append(f"{name}性能分析")
+            lines.append(text)
+        return "\n".join(lines)
+
+
+tracer = Tracer()
@@ -0,0 +1,167 @@
+import re
+import xml.etree.ElementTree as ET
+import xml.parsers.expat
+from collections import namedtuple
+from copy import deepcopy
+
+# Byte offsets of an element: its start tag begins at start, its end tag finishes at end. inner_start and
+# inner_end delimit the content and are None for an empty-element tag; first_child and last_child_end are
+# None when it has no child elements.
+Region = namedtuple("Region", ["start", "end", "inner_start", "inner_end", "first_child", "last_child_end"])
+_WHITESPACE = re.compile(rb"\s*\Z")
+_ATTRIBUTE = r"""\s{}\s*=\s*(["'])(.*?)\1"""
+_TAG_BODY = re.compile(rb"""(?:[^>"']|"[^"]*"|'[^']*')*>""")
+_CHUNK_SIZE = 1 << 20
+
+
+def _tag_end(data: bytes, pos: int):
+    # Offset just past the ">" closing the tag that begins at pos, skipping quoted attribute values
+    return _TAG_BODY.match(data, pos + 1).end()
+
+
+def locate(data: bytes, paths, text_paths=(), check=None):
+    # One expat pass over data. paths are "/" separated below the root, e.g. "Editable/spellIDs"; like ET.find
+    # only the first element of each path is located. text_paths may end in "*" and collect the texts of all
+    # matching elements within the first occurrence of each child of the root. check is called before every
+    # chunk of data is parsed, e.g. to abort by raising.
+    # Returns ({path: Region}, {text path: [texts]}); raises ET.ParseError on malformed input.
+    wanted = {tuple(i.split("/")): i for i in paths}
+    text_wanted = {tuple(i.split("/")): i for i in text_paths}
+    prefixes = set()
+    for key in list(wanted) + list(text_wanted):
+        prefixes.update(key[:i] for i in range(1, len(key) + 1))
+
+    regions = {}
+    texts = {i: [] for i in text_paths}
+    stack = []
+    # Per element on stack: [path key, start offset, first child offset, last child end, start of the open child]
+    open_regions = []
+    seen_top = set()
+    depth = 0
+    text_parts = None
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+
+    def _text_target(key):
+        if key in text_wanted:
+            return text_wanted[key]
+        return text_wanted.get(key[:-1] + ("*", ))
+
+    def _prefix(key):
+        return key in prefixes or key[:-1] + ("*", ) in prefixes
+
+    def _start(tag, attrib):
+        nonlocal depth, text_parts
+        depth += 1
+        if depth == 1 or len(stack) != depth - 2:
+            return
+        start = parser.CurrentByteIndex
+        if len(open_regions) > 0:
+            if open_regions[-1][2] is None:
+                open_regions[-1][2] = start
+            open_regions[-1][4] = start
+        if depth == 2:
+            if tag in seen_top:
+                return
+            seen_top.add(tag)
+        key = tuple(stack) + (tag, )
+        if not _prefix(key):
+            return
+        stack.append(tag)
+        open_regions.append([key, start, None, None, None])
+        if _text_target(key) is not None:
+            text_parts = []
+
+    def _end(tag):
+        nonlocal depth, text_parts
+        closing_depth = depth
+        depth -= 1
+        if closing_depth == 1 or len(stack) < closing_depth - 2:
+            return
+        if len(stack) == closing_depth - 2:
+            # An element nobody asked for, only its parent's last_child_end matters
+            if len(open_regions) > 0:
+                start_end = _tag_end(data, open_regions[-1][4])
+                open_regions[-1][3] = start_end if data[start_end - 2] == 0x2F else \
+                    data.index(b">", parser.CurrentByteIndex) + 1
+            return
+
+        key, start, first_child, last_child_end, _ = open_regions.pop()
+        stack.pop()
+        start_end = _tag_end(data, start)
+        if data[start_end - 2] == 0x2F:
+            # Empty-element tag, expat reports it ended right after "/>"
+            end = start_end
+            inner_start = inner_end = None
+        else:
+            pos = parser.CurrentByteIndex
+            end = data.index(b">", pos) + 1
+            inner_start, inner_end = start_end, pos
+        if len(open_regions) > 0:
+            open_regions[-1][3] = end
+        if key in wanted and wanted[key] not in regions:
+            regions[wanted[key]] = Region(start, end, inner_start, inner_end, first_child, last_child_end)
+        target = _text_target(key)
+        if target is not None:
+            texts[target].append("".join(text_parts))
+            text_parts = None
+
+    def _text(text):
+        if text_parts is not None:
+            text_parts.append(text)
+
+    parser.StartElementHandler = _start
+    parser.EndElementHandler = _end
+    parser.CharacterDataHandler = _text
+    try:
+        view = memoryview(data)
+        for i in range(0, len(view), _CHUNK_SIZE):
+            if check is not None:
+                check()
+            parser.Parse(view[i:i + _CHUNK_SIZE], False)
+        parser.Parse(b"", True)
+    except xml.parsers.expat.ExpatError as e:
+        raise ET.ParseError(str(e))
+    return regions, texts
+
+
+def child_separator(data: bytes, region: Region, default: bytes):
+    # Whitespace the element puts before its first child, reused for children spliced in
+    if region.first_child is not None and _WHITESPACE.match(data, region.inner_start, region.first_child):
+        return data[region.inner_start:region.first_child]
+    return default
+
+
+def start_tag(data: bytes, region: Region):
+    return data[region.start:region.end if region.inner_start is None else region.inner_start]
+
+
+def attribute_span(tag: bytes, name: str):
+    # (start, end) of the value of attribute name within a start tag, None if it has no such attribute
+    matched = re.search(_ATTRIBUTE.format(re.escape(name)).encode("ascii"), tag, re.DOTALL)
+    return None if matched is None else matched.span(2)
+
+
+def apply_edits(data: bytes, edits):
+    # edits are non overlapping (start, end, replacement) byte ranges, the untouched runs are copied through
+    parts = []
+    pos = 0
+    for start, end, replacement in sorted(edits, key=lambda x: (x[0], x[1])):
+        parts.append(data[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(data[pos:])
+    return b"".join(parts)
+
+
+def serialize_element(et: ET.Element, level: int, space: str = "    "):
+    # Text ET.indent + ET.tostring give et inside a whole tree when it sits at level, without its tail
+    result = deepcopy(et)
+    result.tail = None
+    ET.indent(result, space=space, level=level)
+    return ET.tostring(result, encoding="unicode", short_empty_elements=True)
+
+
+def same_content(xml1: str, xml2: str):
+    # Equal up to whitespace between elements and attribute order
+    return ET.canonicalize(xml1, strip_text=True) == ET.canonicalize(xml2, strip_text=True)
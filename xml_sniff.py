@@ -0,0 +1,92 @@
+import xml.etree.ElementTree as ET
+import re
+
+SNIFF_SIZE = 4096
+_ROOT_TAG = re.compile(rb"<([A-Za-z_][\w.\-]*)")
+_SKIPPED = re.compile(rb"\s+|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>]*>", re.DOTALL)
+
+
+def sniff_root_tag(head: bytes):
+    # Root element name from the first bytes of a document, None if it isn't within head
+    pos = 3 if head.startswith(b"\xef\xbb\xbf") else 0
+    while True:
+        skipped = _SKIPPED.match(head, pos)
+        if skipped is None:
+            break
+        pos = skipped.end()
+    matched = _ROOT_TAG.match(head, pos)
+    if matched is None or matched.end() == len(head):
+        return None
+    return matched.group(1).decode("utf8")
+
+
+def _parse_queries(queries):
+    # (path below the root, attribute) pairs; attribute None asks for the text, a path ending in "/*" for the
+    # texts of all children of that element
+    wanted = {}
+    for i, (path, attrib) in enumerate(queries):
+        children = path.endswith("/*")
+        key = tuple((path[:-2] if children else path).split("/"))
+        wanted.setdefault(key, []).append((i, attrib, children))
+    return wanted
+
+
+def _value_of(et: ET.Element, attrib, children):
+    if children:
+        return [i.text for i in et]
+    if attrib is not None:
+        return et.get(attrib)
+    return et.text
+
+
+def scan_values(fp, queries, chunk_size: int = SNIFF_SIZE // 4):
+    # Pull-parses fp only until every query is answered, so usually just the head of the file is decompressed.
+    # Values are those of the first matching element, like ET.find; raises ET.ParseError on malformed input.
+    wanted = _parse_queries(queries)
+    results = [None] * len(queries)
+    answered = [False] * len(queries)
+    remaining = len(queries)
+    parser = ET.XMLPullParser(events=("start", "end"))
+    path = []
+    depth = 0
+
+    def _answer(et, on_start):
+        nonlocal remaining
+        for i, attrib, children in wanted.get(tuple(path), ()):
+            if not answered[i] and (attrib is not None and not children) == on_start:
+                results[i] = _value_of(et, attrib, children)
+                answered[i] = True
+                remaining -= 1
+
+    while remaining > 0:
+        chunk = fp.read(chunk_size)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        for event, et in parser.read_events():
+            if event == "start":
+                if depth > 0:
+                    path.append(et.tag)
+                depth += 1
+                _answer(et, True)
+            else:
+                _answer(et, False)
+                depth -= 1
+                if len(path) > 0:
+                    path.pop()
+            if remaining == 0:
+                break
+        if not chunk:
+            break
+    return results
+
+
+def find_values(root: ET.Element, queries):
+    # Same answers as scan_values from an already parsed tree
+    results = []
+    for path, attrib in queries:
+        children = path.endswith("/*")
+        et = root.find(path[:-2] if children else path)
+        results.append(None if et is None else _value_of(et, attrib, children))
+    return results
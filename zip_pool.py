@@ -0,0 +1,110 @@
+import io
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+from threading import Lock, RLock, get_ident
+from zipfile import ZipFile
+
+
+class ZipHandlePool:
+    # Open ZipFile handles, one per (thread, archive) so threads decompress the same archive concurrently,
+    # at most max_handles of them with the least recently used idle ones closed first.
+    # The central directory of every archive is parsed once and shared by all of its handles. With keep, a test on
+    # entry names, a directory holds only the ZipInfo of the entries that pass it.
+    def __init__(self, max_handles: int = 64, keep=None):
+        self.max_handles = max_handles
+        self.keep = keep
+        self._directories = {}
+        self._handles = OrderedDict()
+        self._in_use = {}
+        self._lock = Lock()
+
+    def _prune(self, zf: ZipFile, infos=None):
+        if infos is None and self.keep is not None:
+            infos = [i for i in zf.filelist if self.keep(i.filename)]
+        if infos is not None:
+            zf.filelist = list(infos)
+            zf.NameToInfo = {i.filename: i for i in zf.filelist}
+
+    def add_directory(self, zip_name: str, zf: ZipFile, infos=None):
+        # Keeps the parsed central directory of zf, or only infos of it, the handle itself is closed
+        zf.close()
+        self._prune(zf, infos)
+        with self._lock:
+            self._directories[zip_name] = zf
+
+    def directory(self, zip_name: str):
+        with self._lock:
+            template = self._directories.get(zip_name)
+        if template is None:
+            template = ZipFile(zip_name)
+            template.close()
+            self._prune(template)
+            with self._lock:
+                template = self._directories.setdefault(zip_name, template)
+        return template
+
+    def _open(self, zip_name: str):
+        # A fresh file handle on the shared directory, without parsing the central directory again
+        zf = copy(self.directory(zip_name))
+        zf.fp = io.open(zip_name, "rb")
+        zf._fileRefCnt = 1
+        zf._lock = RLock()
+        zf._filePassed = 0
+        return zf
+
+    @contextmanager
+    def lease(self, zip_name: str):
+        key = (get_ident(), zip_name)
+        with self._lock:
+            zf = self._handles.get(key)
+            if zf is not None:
+                self._handles.move_to_end(key)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+        try:
+            if zf is None:
+                zf = self._open(zip_name)
+                with self._lock:
+                    self._handles[key] = zf
+                self._evict()
+            yield zf
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                if self._in_use[key] == 0:
+                    del self._in_use[key]
+
+    def _evict(self):
+        # Handles leased at the moment are skipped, they are closed on a later eviction
+        to_close = []
+        with self._lock:
+            excess = len(self._handles) - self.max_handles
+            if excess > 0:
+                for key in list(self._handles):
+                    if excess == 0:
+                        break
+                    if key not in self._in_use:
+                        to_close.append(self._handles.pop(key))
+                        excess -= 1
+        for zf in to_close:
+            zf.close()
+
+    def invalidate(self, zip_name: str):
+        with self._lock:
+            self._directories.pop(zip_name, None)
+            to_close = [(k, self._handles.pop(k)) for k in list(self._handles) if k[1] == zip_name]
+            to_close = [zf for k, zf in to_close if k not in self._in_use]
+        for zf in to_close:
+            zf.close()
+
+    def close(self):
+        with self._lock:
+            to_close = list(self._handles.values())
+            self._handles.clear()
+        for zf in to_close:
+            zf.close()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._handles)
@@ -0,0 +1,37 @@
+import struct
+from copy import copy
+from zipfile import ZipFile, ZipInfo, BadZipFile
+
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+def read_raw(zf: ZipFile, zinfo: ZipInfo):
+    # Compressed bytes of an entry exactly as stored, without inflating them
+    with zf._lock:
+        zf.fp.seek(zinfo.header_offset)
+        header = zf.fp.read(_LOCAL_HEADER_SIZE)
+        if len(header) != _LOCAL_HEADER_SIZE or header[:4] != _LOCAL_HEADER_SIGNATURE:
+            raise BadZipFile(f"Bad local file header for {zinfo.filename}")
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        zf.fp.seek(name_len + extra_len, 1)
+        return zf.fp.read(zinfo.compress_size)
+
+
+def write_raw(zf: ZipFile, zinfo: ZipInfo, raw: bytes):
+    # Append an already compressed stream; zinfo must carry the right CRC, sizes and compress_type
+    zinfo = copy(zinfo)
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = b""
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader())
+        zf.fp.write(raw)
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf.start_dir = zf.fp.tell()
+    return zinfo
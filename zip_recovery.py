@@ -0,0 +1,137 @@
+import mmap
+import struct
+import zlib
+from threading import Lock
+from zipfile import ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_CHUNK_SIZE = 1 << 16
+
+
+class RecoveredInfo(ZipInfo):
+    # ZipInfo that also knows where the entry's data starts. CRC is None where the local header doesn't have it.
+    __slots__ = ("data_offset",)
+
+
+class RecoveredArchive:
+    # Reads entries of a damaged archive straight from their local file headers, without trusting the central
+    # directory or the CRCs. Every data offset found is kept, so later reads of the archive are direct seeks.
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.scanned = False
+        self._lock = Lock()
+
+    @staticmethod
+    def _parse_header(buf, offset: int):
+        # ZipInfo for the local header at offset with header_offset set, None if there is no usable header
+        if offset + _LOCAL_HEADER.size > len(buf):
+            return None
+        (signature, _, flag_bits, compress_type, dos_time, dos_date, crc, compress_size, file_size, name_len,
+         extra_len) = _LOCAL_HEADER.unpack_from(buf, offset)
+        if signature != _LOCAL_HEADER_SIGNATURE or compress_type not in (ZIP_STORED, ZIP_DEFLATED) \
+                or flag_bits & 0x01 or name_len == 0:
+            return None
+        name_bytes = bytes(buf[offset + _LOCAL_HEADER.size:offset + _LOCAL_HEADER.size + name_len])
+        try:
+            name = name_bytes.decode("utf8" if flag_bits & 0x800 else "cp437")
+        except UnicodeDecodeError:
+            return None
+
+        date_time = ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F,
+                     dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2)
+        try:
+            zinfo = RecoveredInfo(name, date_time)
+        except ValueError:
+            zinfo = RecoveredInfo(name)
+        zinfo.flag_bits = flag_bits
+        zinfo.compress_type = compress_type
+        # With a data descriptor the header has no CRC and no sizes, the CRC is left unknown
+        zinfo.CRC = None if flag_bits & 0x08 else crc
+        zinfo.compress_size = compress_size
+        zinfo.file_size = file_size
+        zinfo.header_offset = offset
+        zinfo.data_offset = offset + _LOCAL_HEADER.size + name_len + extra_len
+        return zinfo
+
+    def scan(self):
+        # Walks every local file header signature in the file, returns the number of entries found
+        with self._lock:
+            if self.scanned:
+                return len(self.entries)
+            with open(self.path, "rb") as fp:
+                try:
+                    buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    buf = b""
+                try:
+                    offset = buf.find(_LOCAL_HEADER_SIGNATURE)
+                    while offset >= 0:
+                        zinfo = RecoveredArchive._parse_header(buf, offset)
+                        if zinfo is not None and zinfo.filename not in self.entries:
+                            self.entries[zinfo.filename] = zinfo
+                        offset = buf.find(_LOCAL_HEADER_SIGNATURE, offset + 4)
+                finally:
+                    if isinstance(buf, mmap.mmap):
+                        buf.close()
+            self.scanned = True
+            return len(self.entries)
+
+    def infolist(self):
+        self.scan()
+        return list(self.entries.values())
+
+    def getinfo(self, name: str):
+        with self._lock:
+            zinfo = self.entries.get(name)
+        if zinfo is None:
+            self.scan()
+            zinfo = self.entries[name]
+        return zinfo
+
+    def _locate(self, name: str, header_offset: int = None):
+        with self._lock:
+            zinfo = self.entries.get(name)
+        if zinfo is not None:
+            return zinfo
+        if header_offset is not None:
+            with open(self.path, "rb") as fp:
+                fp.seek(header_offset)
+                head = fp.read(_LOCAL_HEADER.size + 0xFFFF)
+            zinfo = RecoveredArchive._parse_header(head, 0)
+            if zinfo is not None and zinfo.filename == name:
+                zinfo.header_offset = header_offset
+                zinfo.data_offset += header_offset
+                with self._lock:
+                    self.entries[name] = zinfo
+                return zinfo
+        self.scan()
+        return self.entries.get(name)
+
+    def read(self, name: str, header_offset: int = None):
+        # Content of name, None if it can't be found or its data is cut short. The CRC is not checked.
+        zinfo = self._locate(name, header_offset)
+        if zinfo is None:
+            return None
+
+        with open(self.path, "rb") as fp:
+            fp.seek(zinfo.data_offset)
+            if zinfo.compress_type == ZIP_STORED:
+                if zinfo.flag_bits & 0x08:
+                    return None
+                result = fp.read(zinfo.compress_size)
+                return result if len(result) == zinfo.compress_size else None
+
+            decompressor = zlib.decompressobj(-15)
+            result = []
+            while not decompressor.eof:
+                chunk = fp.read(_CHUNK_SIZE)
+                if not chunk:
+                    return None
+                try:
+                    result.append(decompressor.decompress(chunk))
+                except zlib.error:
+                    return None
+            result.append(decompressor.flush())
+            return b"".join(result)